@@ -0,0 +1,484 @@
+import argparse
+import json
+import numpy as np
+import os
+import pandas as pd
+import pyreadstat
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import spss_survey_merge as merge
+
+## -- GENERATE A SYNTHETIC MULTI-WAVE SPSS CORPUS -- ##
+
+#Preset corpus sizes (waves, respondents, variables); 'production' matches the largest trackers this script is run against
+
+corpus_presets = {'small': (5, 2000, 100), 'medium': (20, 20000, 500), 'large': (40, 200000, 3000), 'production': (60, 250000, 4000)}
+
+def generate_synthetic_corpus(directory, waves=20, respondents=20000, variables=200, label_density=1.0, inconsistent_fraction=0.05, singleton_fraction=0.02, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    os.makedirs(directory, exist_ok=True)
+
+    likert_labels = {1: 'Strongly disagree', 2: 'Disagree', 3: 'Neutral', 4: 'Agree', 5: 'Strongly agree'}
+
+    #Singleton variables each appear in exactly one wave; every other variable appears in all waves
+
+    singleton_count = int(variables * singleton_fraction)
+
+    shared_variables = ['Q' + str(i) for i in range(variables - singleton_count)]
+
+    #The first label_density share of shared variables carry value labels, and the last inconsistent_fraction of those gain an extra code in odd-numbered waves
+
+    labelled_variables = shared_variables[:int(len(shared_variables) * label_density)]
+
+    inconsistent_variables = set(labelled_variables[len(labelled_variables) - int(variables * inconsistent_fraction):])
+
+    file_names = []
+
+    for wave in range(waves):
+
+        variable_names = shared_variables + ['S' + str(i) for i in range(singleton_count) if i % waves == wave]
+
+        #int8 codes keep generation memory at one byte per cell, which matters at production scale; pyreadstat stores them as SPSS numerics
+
+        df = pd.DataFrame({var: rng.integers(1, 6, respondents, dtype=np.int8) for var in variable_names})
+
+        column_labels = ['Question ' + var for var in variable_names]
+
+        variable_value_labels = {}
+
+        for var in labelled_variables:
+
+            if var in inconsistent_variables and wave % 2 == 1:
+
+                variable_value_labels[var] = {**likert_labels, 6: 'Not applicable'}
+
+            else:
+
+                variable_value_labels[var] = likert_labels
+
+        file_name = 'wave_' + str(wave).zfill(3) + '.sav'
+
+        pyreadstat.write_sav(df, os.path.join(directory, file_name), column_labels=column_labels, variable_value_labels=variable_value_labels)
+
+        file_names.append(file_name)
+
+        del df
+
+    return file_names
+
+## -- LOCAL FAKE-BOX STAND-IN FOR OFFLINE RUNS -- ##
+
+#Mimics the subset of the boxsdk Client API used by the merge script, serving files from a local directory.  'latency' (seconds per request) and 'bandwidth' (bytes per second per request) simulate a remote connection.  Uploaded files land in 'upload_dir', named by Box file id; 'failure_rate' makes that share of part uploads fail, to exercise retries.
+
+class FakeBoxClient:
+
+    def __init__(self, directory, latency=0.0, bandwidth=None, upload_dir=None, part_size=8 * 1024 * 1024, failure_rate=0.0, seed=0):
+
+        self.directory = directory
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.upload_dir = upload_dir or directory.rstrip(os.sep) + '_uploads'
+        self.part_size = part_size
+        self.failure_rate = failure_rate
+        self.rng = np.random.default_rng(seed)
+
+        os.makedirs(self.upload_dir, exist_ok=True)
+
+    def transfer(self, size):
+
+        time.sleep(self.latency)
+
+        if self.bandwidth:
+
+            time.sleep(size / self.bandwidth)
+
+    def folder(self, folder_id=None):
+
+        return FakeBoxFolder(self)
+
+    def file(self, file_id):
+
+        return FakeBoxFile(self, file_id)
+
+class FakeBoxFolder:
+
+    def __init__(self, client):
+
+        self.client = client
+
+    def get_items(self, fields=None):
+
+        time.sleep(self.client.latency)
+
+        items = []
+
+        for name in sorted(os.listdir(self.client.directory)):
+
+            path = os.path.join(self.client.directory, name)
+
+            #Like Box, sha1 is only returned when asked for; hashing the whole corpus on every listing would skew the timings
+
+            items.append(SimpleNamespace(type='file', id=name, name=name, sha1=merge.hash_file(path) if 'sha1' in (fields or []) else None, size=os.path.getsize(path)))
+
+        return items
+
+class FakeBoxFile:
+
+    def __init__(self, client, file_id):
+
+        self.client = client
+        self.file_id = file_id
+        self.path = os.path.join(client.directory, file_id)
+
+    def get(self, fields=None):
+
+        time.sleep(self.client.latency)
+
+        return SimpleNamespace(id=self.file_id, name=self.file_id, sha1=merge.hash_file(self.path), size=os.path.getsize(self.path))
+
+    def update_contents(self, file_path):
+
+        self.client.transfer(os.path.getsize(file_path))
+
+        shutil.copyfile(file_path, os.path.join(self.client.upload_dir, self.file_id))
+
+        return SimpleNamespace(id=self.file_id, name=os.path.basename(file_path))
+
+    def create_upload_session(self, file_size, file_name=None):
+
+        time.sleep(self.client.latency)
+
+        return FakeUploadSession(self, file_size)
+
+    def download_to(self, writeable_stream, file_version=None, byte_range=None):
+
+        time.sleep(self.client.latency)
+
+        start, end = byte_range if byte_range is not None else (0, os.path.getsize(self.path) - 1)
+
+        with open(self.path, 'rb') as open_file:
+
+            open_file.seek(start)
+
+            remaining = end - start + 1
+
+            while remaining > 0:
+
+                block = open_file.read(min(remaining, 1024 * 1024))
+
+                writeable_stream.write(block)
+
+                remaining -= len(block)
+
+                if self.client.bandwidth:
+
+                    time.sleep(len(block) / self.client.bandwidth)
+
+class FakeUploadSession:
+
+    def __init__(self, box_file, total_size):
+
+        self.box_file = box_file
+        self.client = box_file.client
+        self.total_size = total_size
+        self.part_size = self.client.part_size
+        self.staging_path = os.path.join(self.client.upload_dir, box_file.file_id + '.session')
+
+        with open(self.staging_path, 'wb') as open_file:
+
+            open_file.truncate(total_size)
+
+    def upload_part_bytes(self, part_bytes, offset, total_size, part_content_sha1=None):
+
+        self.client.transfer(len(part_bytes))
+
+        if self.client.rng.random() < self.client.failure_rate:
+
+            raise ConnectionError("Simulated failure uploading part at byte " + str(offset))
+
+        #Parts are written in place, so they may arrive in any order
+
+        with open(self.staging_path, 'r+b') as open_file:
+
+            open_file.seek(offset)
+            open_file.write(part_bytes)
+
+        return {'offset': offset, 'size': len(part_bytes)}
+
+    def commit(self, content_sha1, parts=None, file_attributes=None, etag=None):
+
+        time.sleep(self.client.latency)
+
+        if sum(part['size'] for part in parts) != self.total_size or bytes.fromhex(merge.hash_file(self.staging_path)) != content_sha1:
+
+            raise IOError("Committed parts do not match the file's SHA1")
+
+        os.replace(self.staging_path, os.path.join(self.client.upload_dir, self.box_file.file_id))
+
+        return SimpleNamespace(id=self.box_file.file_id, name=self.box_file.file_id)
+
+    def abort(self):
+
+        if os.path.exists(self.staging_path):
+
+            os.remove(self.staging_path)
+
+## -- BENCHMARK CONCURRENT DOWNLOADS AGAINST WORKER COUNT -- ##
+
+def benchmark_downloads(corpus_dir, worker_counts, latency=0.05, bandwidth=50e6):
+
+    box_client = FakeBoxClient(corpus_dir, latency=latency, bandwidth=bandwidth)
+
+    config = merge.build_config()
+
+    results = []
+
+    for workers in worker_counts:
+
+        shutil.rmtree('temp', ignore_errors=True)
+
+        #Cold run downloads every file; the warm run that follows should skip all of them on matching SHA1
+
+        for run in ['cold', 'warm']:
+
+            start = time.perf_counter()
+
+            downloaded_bytes = merge.download_spss_files(box_client, config, workers=workers)
+
+            elapsed = time.perf_counter() - start
+
+            results.append({'run': run, 'workers': workers, 'seconds': round(elapsed, 3), 'files_downloaded': sum(1 for size in downloaded_bytes if size > 0), 'MB/s': round(sum(downloaded_bytes) / 1e6 / elapsed, 1)})
+
+            print(results[-1])
+
+    return results
+
+## -- BENCHMARK CHUNKED, CONCURRENT UPLOADS AGAINST WORKER COUNT -- ##
+
+def benchmark_uploads(work_dir, worker_counts, size_mb=128, latency=0.05, bandwidth=50e6, failure_rate=0.05):
+
+    #Two outputs of size_mb each stand in for the merged SAV and CSV; random bytes keep any compression out of the measurement
+
+    config = merge.build_config(final_sav_path=os.path.join(work_dir, 'upload.sav'), final_csv_path=os.path.join(work_dir, 'upload.csv'), chunked_upload_threshold=20 * 1024 * 1024)
+
+    for output_format, path in [('sav', config['final_sav_path']), ('csv', config['final_csv_path'])]:
+
+        with open(path, 'wb') as open_file:
+
+            for block in range(size_mb):
+
+                open_file.write(os.urandom(1024 * 1024))
+
+        #post_to_box only uploads outputs the run recorded as written (see write_output), so the stand-ins are recorded the same way
+
+        config['run_report']['outputs'].append({'format': output_format, 'path': path, 'bytes': os.path.getsize(path)})
+
+    box_client = FakeBoxClient(os.path.join(work_dir, 'corpus'), latency=latency, bandwidth=bandwidth, failure_rate=failure_rate)
+
+    results = []
+
+    for workers in worker_counts:
+
+        config['upload_workers'] = workers
+
+        start = time.perf_counter()
+
+        uploads = merge.post_to_box(box_client, config)
+
+        elapsed = time.perf_counter() - start
+
+        results.append({'workers': workers, 'seconds': round(elapsed, 3), 'parts': sum(upload['parts'] for upload in uploads), 'MB/s': round(sum(upload['bytes'] for upload in uploads) / 1e6 / elapsed, 1)})
+
+        print(results[-1])
+
+    return results
+
+## -- BENCHMARK THE FULL MERGE PIPELINE OFFLINE -- ##
+
+def benchmark_pipeline(corpus_dir, file_names, workers=1):
+
+    #Box is replaced by FakeBoxClient, the explicit overrides workbook by an empty sheet, and Mongo (unused by the merge itself) is skipped
+
+    box_client = FakeBoxClient(corpus_dir)
+
+    explicit_overrides = pd.DataFrame({'Force-Include / Force-Exclude': [], 'Variable': []})
+
+    config = merge.build_config(parent_file=file_names[0], read_workers=workers, mongo_uri=None, output_formats=['sav', 'csv', 'parquet'])
+
+    shutil.rmtree(config['temp_dir'], ignore_errors=True)
+    shutil.rmtree(config['cache_dir'], ignore_errors=True)
+
+    run_report = merge.merge_waves(config, box_client=box_client, explicit_overrides=explicit_overrides, until='merge')['run_report']
+
+    #Throughput is only reported for stages that decode rows (rows/s) or read wave files (MB/s), from the per-wave records of that stage; the peak is the stage's own RSS high-water mark (see run_stage)
+
+    results = []
+
+    for stage in run_report['stages']:
+
+        seconds = max(stage['wall_seconds'], 1e-3)
+
+        waves = [wave for wave in run_report['waves'] if wave['stage'] == stage['stage']]
+
+        rows = sum(wave['rows'] or 0 for wave in waves if wave['operation'] == 'read_data')
+        megabytes = sum(wave['bytes_read'] or 0 for wave in waves) / 1e6
+
+        results.append(dict(stage, **{'rows_per_second': round(rows / seconds) if rows else None, 'mb_per_second': round(megabytes / seconds, 1) if megabytes else None}))
+
+        print(results[-1]['stage'].ljust(30) + str(stage['wall_seconds']).rjust(10) + 's' + (str(results[-1]['rows_per_second']) + ' rows/s' if rows else '').rjust(21) + (str(results[-1]['mb_per_second']) + ' MB/s' if megabytes else '').rjust(15) + str(stage['stage_peak_rss_mb']).rjust(10) + ' MB peak')
+
+    #Output formats are written concurrently inside one stage, so each format's own throughput is reported separately
+
+    for output in run_report['outputs']:
+
+        print(('  write ' + output['format']).ljust(30) + str(output['seconds']).rjust(10) + 's' + str(output['rows_per_second']).rjust(14) + ' rows/s' + str(output['mb_per_second']).rjust(10) + ' MB/s')
+
+    return {'stages': results, 'outputs': run_report['outputs']}
+
+## -- BENCHMARK END-TO-END LATENCY OF THE PIPELINED EXECUTOR -- ##
+
+def benchmark_pipelined(corpus_dir, file_names, workers=1, latency=0.1, bandwidth=20e6):
+
+    #Both runs go from an empty temp/cache through download, merge and upload against the same simulated-latency Box; only 'pipelined' differs
+
+    explicit_overrides = pd.DataFrame({'Force-Include / Force-Exclude': [], 'Variable': []})
+
+    results = []
+
+    for pipelined in [False, True]:
+
+        box_client = FakeBoxClient(corpus_dir, latency=latency, bandwidth=bandwidth)
+
+        config = merge.build_config(parent_file=file_names[0], read_workers=workers, mongo_uri=None, merge_mode='columnar', pipelined=pipelined, output_formats=['sav', 'csv', 'parquet'], parquet_file_id='PARQUET_FILE_ID', chunked_upload_threshold=20 * 1024 * 1024)
+
+        shutil.rmtree(config['temp_dir'], ignore_errors=True)
+        shutil.rmtree(config['cache_dir'], ignore_errors=True)
+
+        start = time.perf_counter()
+
+        merge.merge_waves(config, box_client=box_client, explicit_overrides=explicit_overrides, until='upload')
+
+        elapsed = time.perf_counter() - start
+
+        results.append({'pipelined': pipelined, 'workers': workers, 'seconds': round(elapsed, 3)})
+
+        print(results[-1])
+
+    results.append({'latency_reduction': round(1 - results[1]['seconds'] / results[0]['seconds'], 3)})
+
+    print(results[-1])
+
+    return results
+
+## -- BENCHMARK PARALLEL SAV READING AGAINST WORKER COUNT -- ##
+
+def benchmark_parallel_reads(file_names, worker_counts):
+
+    config = merge.build_config()
+
+    results = []
+
+    for metadata_only in [True, False]:
+
+        baseline = None
+
+        for workers in worker_counts:
+
+            start = time.perf_counter()
+
+            merge.read_spss_files(file_names, config, metadata_only=metadata_only, workers=workers)
+
+            elapsed = time.perf_counter() - start
+
+            if baseline is None:
+
+                baseline = elapsed
+
+            results.append({'mode': 'metadata' if metadata_only else 'full', 'workers': workers, 'seconds': round(elapsed, 3), 'speedup': round(baseline / elapsed, 2)})
+
+            print(results[-1])
+
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the SPSS merge pipeline on a synthetic multi-wave corpus.')
+    parser.add_argument('--preset', choices=list(corpus_presets), default='medium', help='Corpus size; --waves/--respondents/--variables override it')
+    parser.add_argument('--waves', type=int)
+    parser.add_argument('--respondents', type=int)
+    parser.add_argument('--variables', type=int)
+    parser.add_argument('--label-density', type=float, default=1.0, help='Share of variables carrying value labels')
+    parser.add_argument('--inconsistent-fraction', type=float, default=0.05, help='Share of variables whose value labels change between waves')
+    parser.add_argument('--singleton-fraction', type=float, default=0.02, help='Share of variables that appear in only one wave')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--suites', nargs='+', default=['pipeline'], choices=['pipeline', 'pipelined', 'reads', 'downloads', 'uploads'])
+    parser.add_argument('--upload-mb', type=int, default=128, help='Size of each simulated output in the uploads suite')
+    parser.add_argument('--output', default=None, help='Write all results to this JSON file')
+    args = parser.parse_args()
+
+    waves, respondents, variables = corpus_presets[args.preset]
+
+    waves = args.waves or waves
+    respondents = args.respondents or respondents
+    variables = args.variables or variables
+
+    results = {'corpus': {'waves': waves, 'respondents': respondents, 'variables': variables, 'label_density': args.label_density, 'inconsistent_fraction': args.inconsistent_fraction, 'singleton_fraction': args.singleton_fraction}}
+
+    if args.output:
+
+        args.output = os.path.abspath(args.output)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+
+        #The corpus stands in for the Box folder; the merge functions then work in a 'temp' folder relative to the working directory
+
+        corpus_dir = os.path.join(work_dir, 'corpus')
+
+        file_names = generate_synthetic_corpus(corpus_dir, waves, respondents, variables, args.label_density, args.inconsistent_fraction, args.singleton_fraction)
+
+        os.chdir(work_dir)
+
+        if 'pipeline' in args.suites:
+
+            for workers in args.workers:
+
+                print("PIPELINE (" + str(workers) + " read workers)")
+
+                results['pipeline_' + str(workers) + '_workers'] = benchmark_pipeline(corpus_dir, file_names, workers)
+
+        if 'pipelined' in args.suites:
+
+            for workers in args.workers:
+
+                print("PIPELINED vs SEQUENTIAL END TO END (" + str(workers) + " read workers)")
+
+                results['pipelined_' + str(workers) + '_workers'] = benchmark_pipelined(corpus_dir, file_names, workers)
+
+        if 'downloads' in args.suites:
+
+            results['downloads'] = benchmark_downloads(corpus_dir, args.workers)
+
+        if 'uploads' in args.suites:
+
+            results['uploads'] = benchmark_uploads(work_dir, args.workers, args.upload_mb)
+
+        if 'reads' in args.suites:
+
+            shutil.rmtree('temp', ignore_errors=True)
+            shutil.copytree(corpus_dir, 'temp')
+
+            results['reads'] = benchmark_parallel_reads(file_names, args.workers)
+
+    if args.output:
+
+        with open(args.output, 'w') as open_file:
+
+            json.dump(results, open_file, indent=2)
@@ -0,0 +1,2960 @@
+import argparse
+import asyncio
+from cmath import nanj
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import copy
+import cProfile
+import fnmatch
+import functools
+import gzip
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import re
+import shutil
+import threading
+import time
+import tracemalloc
+
+#boxsdk, certifi, pymongo and pyreadstat are imported inside the stages that use them, so importing this module (or a dry run) stays fast
+
+try:
+
+    import resource #Unix only; peak RSS is reported as None elsewhere
+
+except ImportError:
+
+    resource = None
+
+### -- DEFAULT CONFIGURATION -- ###
+
+#Every setting the merge reads.  Pass overrides to merge_waves (or a JSON file to the command line) instead of editing this dict.
+
+default_config = {
+    'parent_file': 'PARENT_FILE',
+    'retain_specific_files': [],
+    'wave_order': [], #Files in chronological order, oldest first (the parent file included); files not listed follow in name order, with numbers compared numerically ('w2' before 'w10')
+    'always_retain': [], #Add variables manually if need be; like the overrides workbook, entries may be glob patterns ('Q12_*') or regexes prefixed with 're:'
+    'always_remove': [], #Add variables manually if need be
+    'box_settings_file': 'box_json.json', #file is hidden from public repository
+    'spss_folder_id': 'DIRECTORY_ID', #Box folder holding every wave's SAV file
+    'overrides_file_id': 'FILE_ID', #Box file id of the explicit overrides workbook
+    'overrides_path': 'explicit_overrides.xlsx',
+    'mongo_uri': 'MONGO_CLIENT', #Client credentials are hidden from public repository; None skips the Mongo connection
+    'reclassify': True, #Recode wave values with the mapping and correction documents in Mongo (or their local cache when offline)
+    'reclassification_collections': ['mappings', 'corrections'], #Applied in this order, so a correction sees values already recoded by a mapping
+    'output_folder_id': 'FOLDER_ID_HERE',
+    'sav_file_id': 'SPSS_FILE_ID_HERE',
+    'csv_file_id': 'CSV_FILE_ID_HERE',
+    'temp_dir': 'temp', #Local copies of the Box SAV files; kept between runs so unchanged waves are not downloaded again
+    'read_workers': 1, #Number of processes used to read SAV files in parallel (1 = read sequentially in this process)
+    'download_workers': 4, #Maximum number of concurrent Box downloads
+    'upload_workers': 4, #Concurrent part uploads per output file when a chunked upload session is used
+    'upload_retries': 3, #Attempts per part (or per whole-file upload) before the upload is abandoned
+    'chunked_upload_threshold': 50 * 1024 * 1024, #Outputs at least this large (bytes) are sent through a Box chunked upload session; Box requires at least 20 MB
+    'pipelined': False, #Overlap stages with asyncio: waves are read for metadata as they download, decoded while earlier waves are written to the columnar store (merge_mode 'columnar'), and each output is uploaded as soon as it is written
+    'merge_mode': 'memory', #'memory' concatenates every wave in RAM; 'streaming' reads each wave in row chunks and appends them to the merged CSV, so peak memory is bounded by chunk_size; 'columnar' stages each wave in a memory-mapped Arrow file under temp_dir (requires pyarrow)
+    'chunk_size': 100000, #Rows per chunk when merge_mode is 'streaming'
+    'output_formats': ['sav', 'csv'], #Formats written from the merged dataset, concurrently: any of 'sav', 'csv' and 'parquet' (requires pyarrow)
+    'narrow_dtypes': True, #Store labelled codes as nullable int8/int16, 'wave' and repetitive text as categoricals while merging; re-widened when the SAV is written
+    'final_sav_path': 'FinalSPSSFile.sav',
+    'final_csv_path': 'FinalCSVDataFrameCopy.csv', #End the path in '.gz' to gzip the CSV
+    'final_parquet_path': 'FinalParquetFile.parquet',
+    'parquet_file_id': None, #Box file id the Parquet output is uploaded to; None leaves it local
+    'use_wave_cache': True, #Reuse each wave's extracted metadata and projected data from previous runs when its content is unchanged
+    'cache_dir': 'cache', #Persistent per-wave cache; unlike temp_dir, this folder is never cleaned up
+    'label_strategy': 'drop', #How variables whose value labels differ between waves are handled: 'drop' (exclude unless force-included), 'union', 'parent-wins' or 'recode-to-parent'
+    'label_strategies': {}, #Per-variable exceptions to label_strategy, e.g. {'Q12': 'recode-to-parent'}
+    'metadata_precedence': 'parent', #Which wave's label, value labels, measure and width a variable takes when waves differ: 'parent' (the parent file, then the earliest wave carrying it) or 'latest' (the most recent wave carrying it, per wave_order)
+    'metadata_overrides': {}, #Per-variable metadata that wins over every wave, e.g. {'Q12': {'label': 'Overall satisfaction', 'measure': 'ordinal', 'value_labels': {'1': 'Low', '5': 'High'}}}
+    'min_wave_appearances': 2, #Variables must appear in at least this many files to be kept (lower to 1 to keep variables that only appear in one file)
+    'min_recent_waves': 0, #Variables must also appear in each of this many most recent active waves (see wave_order) to be kept, e.g. 2 drops questions retired since the last two waves; 0 disables the rule
+    'run_report_path': 'run_report.json', #Machine-readable timing/memory/IO report written at the end of each run
+    'profile_stage': None, #Name of one stage (e.g. 'construct_csv') to profile with cProfile and tracemalloc; dumps are written next to the run report
+}
+
+def build_config(settings=None, **overrides):
+
+    settings = dict(settings or {}, **overrides)
+
+    #Per-run state (see below) is dropped so an existing config can be passed back in to start a fresh run
+
+    settings = {key: value for key, value in settings.items() if key not in ['box_file_ids', 'reclassifications', 'file_hashes', 'run_report']}
+
+    unknown_settings = set(settings) - set(default_config)
+
+    if unknown_settings:
+
+        raise ValueError("Unknown configuration settings: " + str(sorted(unknown_settings)))
+
+    if settings.get('upload_retries', 1) < 1:
+
+        raise ValueError("upload_retries must be at least 1 (it counts attempts, including the first).")
+
+    config = copy.deepcopy(default_config)
+    config.update(settings)
+
+    #Per-run state is kept on the config rather than in module globals, so separate runs in one process never share it
+
+    config['box_file_ids'] = {} #Box file id of each downloaded SAV file, keyed by file name (filled in by download_spss_files)
+    config['reclassifications'] = [] #Compiled recode rules applied to every wave (filled in by load_reclassifications)
+    config['file_hashes'] = None #SHA1 memo of local waves, loaded from cache_dir on first use (see hash_wave)
+    config['run_report'] = {'stages': [], 'waves': [], 'outputs': [], 'uploads': [], 'plan': None, 'label_reconciliation': {}, 'metadata_validation': None, 'active_stage': None}
+
+    return config
+
+### -- STAGE-LEVEL TIMING, MEMORY AND IO INSTRUMENTATION -- ###
+
+def read_io_counters():
+
+    #Linux exposes the bytes this process has read/written (including page-cache hits) in /proc/self/io; other platforms report None
+
+    try:
+
+        with open('/proc/self/io') as open_file:
+
+            counters = dict(line.split(': ') for line in open_file.read().splitlines())
+
+        return int(counters['rchar']), int(counters['wchar'])
+
+    except (OSError, KeyError, ValueError):
+
+        return None, None
+
+def read_peak_rss_mb(who='self'):
+
+    #ru_maxrss is the high-water mark over the whole process lifetime (KB on Linux, bytes on macOS), so a stage's value is the peak reached by the end of that stage
+
+    if resource is None:
+
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+
+    return round(usage.ru_maxrss / (1024 * 1024 if os.uname().sysname == 'Darwin' else 1024), 1)
+
+#ru_maxrss only ever rises, so on its own it cannot say which stage caused the peak.  On Linux a process may reset its own high-water mark (VmHWM) by writing '5' to /proc/self/clear_refs; each stage resets it on entry and reads it on exit, giving that stage's own peak.  The reset is process-wide, so concurrent stages (see run_batch) share it.
+
+def reset_stage_peak_rss():
+
+    try:
+
+        with open('/proc/self/clear_refs', 'w') as open_file:
+
+            open_file.write('5')
+
+        return True
+
+    except OSError:
+
+        return False
+
+def read_stage_peak_rss_mb():
+
+    try:
+
+        with open('/proc/self/status') as open_file:
+
+            for line in open_file:
+
+                if line.startswith('VmHWM:'):
+
+                    return round(int(line.split()[1]) / 1024, 1)
+
+    except OSError:
+
+        return None
+
+def run_stage(config, name, function, *args, **kwargs):
+
+    run_report = config['run_report']
+
+    profiling = name == config['profile_stage']
+
+    if profiling:
+
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+
+    run_report['active_stage'] = name
+
+    #The reset also lowers ru_maxrss, so the lifetime peak is carried over from the stages before this one
+
+    previous_peak_rss_mb = max([stage['peak_rss_mb'] or 0 for stage in run_report['stages']] + [0])
+
+    peak_reset = reset_stage_peak_rss()
+
+    bytes_read, bytes_written = read_io_counters()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    #The profiler and tracemalloc are stopped even if the stage fails, so a failed run never leaves tracing on for the rest of the process
+
+    try:
+
+        result = function(*args, **kwargs)
+
+    finally:
+
+        if profiling:
+
+            profiler.disable()
+
+            tracemalloc_peak_mb = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+            tracemalloc_snapshot = tracemalloc.take_snapshot()
+
+            tracemalloc.stop()
+
+    stage = {'stage': name,
+        'wall_seconds': round(time.perf_counter() - wall_start, 3),
+        'cpu_seconds': round(time.process_time() - cpu_start, 3),
+        'peak_rss_mb': max(read_peak_rss_mb('self') or 0, previous_peak_rss_mb) if resource is not None else None,
+        'stage_peak_rss_mb': read_stage_peak_rss_mb() if peak_reset else None,
+        'children_peak_rss_mb': read_peak_rss_mb('children')}
+
+    bytes_read_end, bytes_written_end = read_io_counters()
+
+    stage['bytes_read'] = None if bytes_read is None else bytes_read_end - bytes_read
+    stage['bytes_written'] = None if bytes_written is None else bytes_written_end - bytes_written
+
+    run_report['active_stage'] = None
+
+    if profiling:
+
+        report_dir = os.path.dirname(os.path.abspath(config['run_report_path']))
+
+        stage['profile'] = os.path.join(report_dir, 'profile_' + name + '.prof')
+        stage['tracemalloc_snapshot'] = os.path.join(report_dir, 'tracemalloc_' + name + '.snapshot')
+        stage['tracemalloc_peak_mb'] = tracemalloc_peak_mb
+
+        profiler.dump_stats(stage['profile'])
+        tracemalloc_snapshot.dump(stage['tracemalloc_snapshot'])
+
+    run_report['stages'].append(stage)
+
+    print("STAGE " + name + ": " + str(stage['wall_seconds']) + "s wall, " + str(stage['cpu_seconds']) + "s CPU, stage peak RSS " + str(stage['stage_peak_rss_mb']) + " MB (process peak " + str(stage['peak_rss_mb']) + " MB)")
+
+    return result
+
+def record_wave(config, operation, file, seconds, bytes_read=None, rows=None, columns=None):
+
+    run_report = config['run_report']
+
+    run_report['waves'].append({'stage': run_report['active_stage'], 'operation': operation, 'file': file, 'seconds': round(seconds, 3), 'bytes_read': bytes_read, 'rows': rows, 'columns': columns})
+
+def write_run_report(config, path=None):
+
+    if path is None:
+
+        path = config['run_report_path']
+
+    report = {key: value for key, value in config['run_report'].items() if key != 'active_stage'}
+
+    with open(path, 'w') as open_file:
+
+        json.dump(report, open_file, indent=2)
+
+    print("Run report written to " + str(path))
+
+### -- ESTABLISH CONNECTION TO BOX -- ###
+
+def establish_box_connection(config):
+
+    from boxsdk import JWTAuth, Client
+
+    auth = JWTAuth.from_settings_file(config['box_settings_file']) #file is hidden from public repository
+    box_client = Client(auth)
+
+    service_account = box_client.user().get()
+
+    print(f"Connected to: {service_account}")
+
+    return box_client
+
+#Download SPSS files from Box to Local Directory
+
+def download_spss_file(box_client, item, config):
+
+    file_name = os.path.join(config['temp_dir'], str(item.name))
+
+    #Files whose local SHA1 already matches Box are left untouched
+
+    if os.path.exists(file_name) and hash_wave(file_name, config) == item.sha1:
+
+        return 0
+
+    #Downloads go to a '.part' file first; if a previous run was interrupted, the download resumes from the bytes already on disk
+
+    part_name = file_name + '.part'
+
+    offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+
+    if offset >= item.size:
+
+        offset = 0
+
+    start = time.perf_counter()
+
+    with open(part_name, 'ab' if offset > 0 else 'wb') as open_file:
+
+        if offset > 0:
+
+            box_client.file(item.id).download_to(open_file, byte_range=(offset, item.size - 1))
+
+        else:
+
+            box_client.file(item.id).download_to(open_file)
+
+    #A corrupt or stale partial download is discarded so the next run starts that file from scratch
+
+    if hash_file(part_name) != item.sha1:
+
+        os.remove(part_name)
+
+        raise IOError("Checksum mismatch after downloading " + str(item.name) + " from Box.")
+
+    os.replace(part_name, file_name)
+
+    remember_file_hash(file_name, item.sha1, config)
+
+    record_wave(config, 'download', item.name, time.perf_counter() - start, bytes_read=item.size - offset)
+
+    return item.size - offset
+
+def list_spss_items(box_client, config):
+
+    folder_id = config['spss_folder_id']
+
+    temp_dir = config['temp_dir']
+
+    directory_items = [item for item in box_client.folder(folder_id=folder_id).get_items(fields=['type', 'id', 'name', 'sha1', 'size']) if item.type == 'file']
+
+    #'temp' is kept between runs so unchanged waves do not have to be downloaded again; files no longer in the Box folder are removed (directories are left alone)
+
+    os.makedirs(temp_dir, exist_ok=True)
+
+    for file_name in set(os.listdir(temp_dir)) - set(item.name for item in directory_items) - set(item.name + '.part' for item in directory_items):
+
+        if os.path.isfile(os.path.join(temp_dir, file_name)):
+
+            os.remove(os.path.join(temp_dir, file_name))
+
+    for item in directory_items:
+
+        config['box_file_ids'][item.name] = str(item.id)
+
+    return directory_items
+
+def download_spss_files(box_client, config, workers=None):
+
+    if workers is None:
+
+        workers = config['download_workers']
+
+    directory_items = list_spss_items(box_client, config)
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        downloaded_bytes = list(executor.map(lambda item: download_spss_file(box_client, item, config), directory_items))
+
+    elapsed = time.perf_counter() - start
+
+    downloaded_files = sum(1 for size in downloaded_bytes if size > 0)
+
+    print("Downloaded " + str(downloaded_files) + " of " + str(len(directory_items)) + " files (" + str(len(directory_items) - downloaded_files) + " unchanged) - " + str(round(sum(downloaded_bytes) / 1e6 / max(elapsed, 1e-9), 1)) + " MB/s")
+
+    return downloaded_bytes
+
+#Establish & properly order list of files in 'temp' directory
+            
+def determine_import_list(config):
+
+    parent_file = config['parent_file']
+
+    directory_files = os.listdir(config['temp_dir'])
+
+    #Waves are listed in chronological order (see wave_order) rather than the arbitrary order os.listdir returns them in
+
+    all_original_spss_files = chronological_order([item for item in directory_files if item.endswith('.sav')], config)
+
+    all_original_spss_files.insert(0, all_original_spss_files.pop(all_original_spss_files.index(parent_file))) #Moves the parent file to the top of the sequence, so it will serve as the reference file in any overridden metadata conflicts
+
+    return all_original_spss_files
+
+def natural_sort_key(file):
+
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', str(file))]
+
+def chronological_order(files, config):
+
+    listed = [file for file in config['wave_order'] if file in files]
+
+    return listed + sorted([file for file in files if file not in listed], key=natural_sort_key)
+
+### -- IMPORT BOX SHEET WITH EXPLICIT VARIABLE INCLUSION/EXCLUSION MANUAL OVERRIDES -- ##
+
+def download_explicit_overrides(box_client, config):
+        
+    file_id = config['overrides_file_id']
+
+    #The workbook is only downloaded when Box's SHA1 differs from the local copy; an untouched copy also keeps its mtime, so the compiled rules below stay valid
+
+    box_file = box_client.file(file_id).get(fields=['sha1'])
+
+    if not (os.path.exists(config['overrides_path']) and hash_file(config['overrides_path']) == box_file.sha1):
+
+        with open(config['overrides_path'], 'wb') as open_file:
+
+            box_client.file(file_id).download_to(open_file)
+
+    return load_override_rules(config)
+
+def load_local_explicit_overrides(config):
+
+    #Offline runs use the last downloaded workbook if there is one, and otherwise apply no overrides
+
+    if os.path.exists(config['overrides_path']):
+
+        return load_override_rules(config)
+
+    return compile_override_rules(pd.DataFrame({'Force-Include / Force-Exclude': [], 'Variable': []}))
+
+## -- COMPILE EXPLICIT OVERRIDES INTO A CACHED RULE INDEX -- ##
+
+#Override entries are exact variable names, glob patterns ('Q12_*', 'S?_open') or regular expressions prefixed with 're:'.  Exact names go into a hash set; all patterns of one action are joined into a single regex.
+
+def compile_override_rules(explicit_overrides):
+
+    actions = explicit_overrides['Force-Include / Force-Exclude']
+
+    rules = {}
+
+    for action, marker in [('include', 'FORCE-INCLUDE'), ('exclude', 'FORCE EXCLUDE')]:
+
+        entries = [str(entry).strip() for entry in explicit_overrides.loc[actions == marker, 'Variable'].dropna()]
+
+        rules[action] = {'names': sorted(set(entry for entry in entries if not is_override_pattern(entry))),
+            'patterns': sorted(set(override_pattern_regex(entry) for entry in entries if is_override_pattern(entry)))}
+
+    return rules
+
+def is_override_pattern(entry):
+
+    return entry.startswith('re:') or any(char in entry for char in '*?[')
+
+def override_pattern_regex(entry):
+
+    return entry[3:] if entry.startswith('re:') else fnmatch.translate(entry)
+
+def load_override_rules(config):
+
+    path = config['overrides_path']
+
+    cache_path = os.path.join(config['cache_dir'], 'override_rules.json')
+
+    stat = os.stat(path)
+
+    cached = None
+
+    if os.path.exists(cache_path):
+
+        with open(cache_path) as open_file:
+
+            cached = json.load(open_file)
+
+    #An unchanged mtime and size skip hashing altogether; a touched but identical workbook is caught by its SHA1, and only a changed one is parsed again
+
+    if cached and [cached['mtime'], cached['size']] == [stat.st_mtime, stat.st_size]:
+
+        return cached['rules']
+
+    workbook_hash = hash_file(path)
+
+    if cached and cached['sha1'] == workbook_hash:
+
+        rules = cached['rules']
+
+    else:
+
+        print("Compiling explicit overrides from " + path)
+
+        rules = compile_override_rules(pd.read_excel(path, usecols=['Force-Include / Force-Exclude', 'Variable']))
+
+    os.makedirs(config['cache_dir'], exist_ok=True)
+
+    with open(cache_path + '.tmp', 'w') as open_file:
+
+        json.dump({'sha1': workbook_hash, 'mtime': stat.st_mtime, 'size': stat.st_size, 'rules': rules}, open_file, indent=2)
+
+    os.replace(cache_path + '.tmp', cache_path)
+
+    return rules
+
+def match_override_rules(variables, action_rules):
+
+    #One pass over every variable: a hash-set lookup for exact names and one combined regex for the patterns
+
+    variables = pd.Series(variables, dtype=object)
+
+    matched = variables.isin(action_rules['names']).to_numpy(copy=True)
+
+    if action_rules['patterns']:
+
+        combined = re.compile('|'.join('(?:' + pattern + ')' for pattern in action_rules['patterns']))
+
+        matched |= variables.str.fullmatch(combined).to_numpy(dtype=bool)
+
+    return matched
+
+### -- IMPORT DATA FROM MONGODB FOR RECLASSIFICATION SYSTEM -- ##
+    
+def connect_to_mongo(config):
+
+    import certifi
+    import pymongo
+
+    ca = certifi.where()
+
+    client = pymongo.MongoClient(config['mongo_uri'], tlsCAFile=ca) #Client credentials are hidden from public repository
+
+    db = client['SampleSPSS-MappingAndCorrections']
+
+    # ** add additional database connections here as they become apparent ***
+
+    return db
+
+## -- COMPILE AND APPLY MONGO RECLASSIFICATIONS -- ##
+
+#Each mapping or correction document recodes one variable: {'variable': 'Q5', 'mapping': {'6': 5, '-99': None}, 'files': ['wave_003.sav'], 'updated_at': <datetime>}.  Mongo keys are strings, so numeric codes are parsed back; None recodes to missing.  'files' is optional and limits the rule to those waves.
+
+def reclassification_version(mongo_db, config):
+
+    #Mongo has no etag, so a collection's document count and newest 'updated_at' stand in for one; neither fetches the documents themselves (index 'updated_at' to keep the second cheap)
+
+    version = {}
+
+    for collection in config['reclassification_collections']:
+
+        newest = mongo_db[collection].find_one({}, {'updated_at': 1}, sort=[('updated_at', -1)])
+
+        version[collection] = [mongo_db[collection].estimated_document_count(), str(newest.get('updated_at')) if newest else None]
+
+    return version
+
+def load_reclassifications(mongo_db, config):
+
+    cache_path = os.path.join(config['cache_dir'], 'reclassifications.json')
+
+    cached = None
+
+    if os.path.exists(cache_path):
+
+        with open(cache_path) as open_file:
+
+            cached = json.load(open_file)
+
+    if mongo_db is None:
+
+        #Offline runs reuse the documents fetched by the last online run, if any
+
+        documents = cached['documents'] if cached else []
+
+    else:
+
+        version = reclassification_version(mongo_db, config)
+
+        if cached and cached['version'] == version:
+
+            print("Reclassification documents unchanged; using the local cache.")
+
+            documents = cached['documents']
+
+        else:
+
+            #One bulk query per collection; '_id' is dropped so the documents can be cached as JSON
+
+            documents = [document for collection in config['reclassification_collections'] for document in mongo_db[collection].find({}, {'_id': 0, 'variable': 1, 'mapping': 1, 'files': 1})]
+
+            os.makedirs(config['cache_dir'], exist_ok=True)
+
+            with open(cache_path + '.tmp', 'w') as open_file:
+
+                json.dump({'version': version, 'documents': documents}, open_file, indent=2)
+
+            os.replace(cache_path + '.tmp', cache_path)
+
+    config['reclassifications'] = compile_reclassifications(documents)
+
+    print("Loaded " + str(len(config['reclassifications'])) + " reclassification rules.")
+
+    return config['reclassifications']
+
+def parse_code(code):
+
+    try:
+
+        return float(code)
+
+    except (TypeError, ValueError):
+
+        return None
+
+#A dense lookup is only built when the codes it spans are close together; one far-off code (e.g. a 999999999 missing code) would otherwise allocate gigabytes, so such rules use the dictionary replace instead
+
+max_lookup_span = 65536
+
+def is_integer_code(code):
+
+    return code is not None and np.isfinite(code) and float(code).is_integer()
+
+def compile_reclassifications(documents):
+
+    rules = []
+
+    for document in documents:
+
+        mapping = {key: np.nan if value is None else value for key, value in document['mapping'].items()}
+
+        numeric_codes = [parse_code(key) for key in mapping]
+
+        rule = {'variable': document['variable'], 'files': set(document['files']) if document.get('files') else None, 'mapping': mapping, 'numeric_mapping': {code: value for code, value in zip(numeric_codes, mapping.values()) if code is not None}, 'lookup': None}
+
+        #Integer codes recoded to numbers compile to a dense lookup array over [offset, offset + len(lookup)), so recoding a column is a single np.take; untouched codes map to themselves
+
+        if mapping and all(is_integer_code(code) for code in numeric_codes) and all(isinstance(value, (int, float)) for value in mapping.values()) and max(numeric_codes) - min(numeric_codes) < max(max_lookup_span, 16 * len(mapping)):
+
+            offset = int(min(numeric_codes))
+
+            lookup = np.arange(offset, int(max(numeric_codes)) + 1, dtype='float64')
+
+            for code, value in zip(numeric_codes, mapping.values()):
+
+                lookup[int(code) - offset] = value
+
+            rule['lookup'] = lookup
+            rule['offset'] = offset
+
+        rules.append(rule)
+
+    return rules
+
+def apply_reclassifications(df, file, reclassifications):
+
+    for rule in reclassifications:
+
+        var = rule['variable']
+
+        if var not in df.columns or (rule['files'] is not None and file not in rule['files']):
+
+            continue
+
+        if rule['lookup'] is not None and pd.api.types.is_numeric_dtype(df[var]):
+
+            values = df[var].to_numpy(dtype='float64', na_value=np.nan, copy=True)
+
+            #NaN and codes outside the lookup fail both comparisons, so they are left as they are
+
+            positions = values - rule['offset']
+
+            hit = (positions >= 0) & (positions < len(rule['lookup'])) & (positions == np.floor(positions))
+
+            values[hit] = np.take(rule['lookup'], positions[hit].astype(np.int64))
+
+            df[var] = values
+
+        else:
+
+            #Text columns, and rules that are not integer-to-number, are recoded with a vectorized dictionary replace
+
+            df[var] = df[var].replace(rule['numeric_mapping'] if pd.api.types.is_numeric_dtype(df[var]) else rule['mapping'])
+
+    return df
+
+## -- READ SPSS FILES, OPTIONALLY ACROSS A PROCESS POOL -- ##
+
+def read_spss_files(files, config, metadata_only=False, workers=None, usecols=None, executor=None):
+
+    if workers is None:
+
+        workers = config['read_workers']
+
+    paths = [os.path.join(config['temp_dir'], str(file)) for file in files]
+
+    #usecols, if given, holds one list of column names per file; only those columns are decoded by pyreadstat
+
+    if usecols is None:
+
+        usecols = [None] * len(paths)
+
+    operation = 'read_metadata' if metadata_only else 'read_data'
+
+    if executor is not None:
+
+        #A caller that keeps a process pool open across calls (see decode_and_store_waves) has the reads run there, even one wave at a time
+
+        timed_results = [future.result() for future in [executor.submit(timed_read_sav, path, metadata_only, cols) for path, cols in zip(paths, usecols)]]
+
+    elif workers <= 1 or len(paths) <= 1:
+
+        timed_results = [timed_read_sav(path, metadata_only, cols) for path, cols in zip(paths, usecols)]
+
+    else:
+
+        #Each read is timed inside its worker, so the report shows which wave was slow rather than the pool's average.  Results are collected in submission order, so the parent file stays first.
+
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+
+            futures = [executor.submit(timed_read_sav, path, metadata_only, cols) for path, cols in zip(paths, usecols)]
+
+            timed_results = [future.result() for future in futures]
+
+    for file, path, (df, meta, seconds) in zip(files, paths, timed_results):
+
+        record_wave(config, operation, file, seconds, bytes_read=os.path.getsize(path), rows=meta.number_rows, columns=len(df.columns))
+
+    return [(df, meta) for df, meta, seconds in timed_results]
+
+def timed_read_sav(path, metadata_only=False, usecols=None):
+
+    import pyreadstat
+
+    start = time.perf_counter()
+
+    df, meta = pyreadstat.read_sav(path, metadataonly=metadata_only, usecols=usecols)
+
+    return df, meta, time.perf_counter() - start
+
+## -- READ SPSS METADATA ONLY (NO ROW DATA) -- ##
+
+def read_spss_metadata(files, config, workers=None):
+
+    #metadataonly=True parses the SAV dictionary only - row data is never decoded, so this is fast regardless of the number of respondents in the wave
+
+    return [meta for df, meta in read_spss_files(files, config, metadata_only=True, workers=workers)]
+
+## -- PERSISTENT PER-WAVE CACHE, KEYED BY BOX FILE ID AND CONTENT HASH -- ##
+
+def hash_file(path):
+
+    #SHA1 is the checksum Box reports for each file, so local and remote hashes can be compared directly
+
+    sha1 = hashlib.sha1()
+
+    with open(path, 'rb') as open_file:
+
+        for block in iter(lambda: open_file.read(1024 * 1024), b''):
+
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+#Every stage that needs a wave's SHA1 (download check, wave cache, pipelined reader) asks hash_wave, which remembers each hash with the size and modification time it was computed for; an unchanged wave is hashed once, not once per stage per run.  Hashes verified against Box on download are remembered without hashing again.
+
+file_hash_lock = threading.Lock()
+
+def load_file_hashes(config):
+
+    if config['file_hashes'] is None:
+
+        path = os.path.join(config['cache_dir'], 'file_hashes.json')
+
+        config['file_hashes'] = {}
+
+        if os.path.exists(path):
+
+            with open(path) as open_file:
+
+                config['file_hashes'] = json.load(open_file)
+
+    return config['file_hashes']
+
+def remember_file_hash(path, sha1, config):
+
+    stat = os.stat(path)
+
+    with file_hash_lock:
+
+        file_hashes = load_file_hashes(config)
+        file_hashes[os.path.abspath(path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1}
+
+        os.makedirs(config['cache_dir'], exist_ok=True)
+
+        memo_path = os.path.join(config['cache_dir'], 'file_hashes.json')
+
+        with open(memo_path + '.tmp', 'w') as open_file:
+
+            json.dump(file_hashes, open_file)
+
+        os.replace(memo_path + '.tmp', memo_path)
+
+    return sha1
+
+def hash_wave(path, config):
+
+    stat = os.stat(path)
+
+    with file_hash_lock:
+
+        entry = load_file_hashes(config).get(os.path.abspath(path))
+
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+
+        return entry['sha1']
+
+    return remember_file_hash(path, hash_file(path), config)
+
+#Waves decoded concurrently (see 'pipelined') update the cache index from several threads; the lock keeps each load-modify-save of index.json atomic
+
+cache_index_lock = threading.Lock()
+
+def load_cache_index(config):
+
+    index_path = os.path.join(config['cache_dir'], 'index.json')
+
+    if not config['use_wave_cache'] or not os.path.exists(index_path):
+
+        return {}
+
+    with open(index_path) as open_file:
+
+        return json.load(open_file)
+
+def save_cache_index(cache_index, config):
+
+    if not config['use_wave_cache']:
+
+        return
+
+    os.makedirs(config['cache_dir'], exist_ok=True)
+
+    #Written to a scratch file first so an interrupted run never leaves a truncated index behind
+
+    index_path = os.path.join(config['cache_dir'], 'index.json')
+
+    with open(index_path + '.tmp', 'w') as open_file:
+
+        json.dump(cache_index, open_file, indent=2)
+
+    os.replace(index_path + '.tmp', index_path)
+
+def find_cache_entry(cache_index, file, file_hash, config):
+
+    #Returns the cache entry for a wave only if it was built from identical file contents
+
+    entry = cache_index.get(config['box_file_ids'].get(file, file))
+
+    if entry is not None and entry['sha1'] == file_hash:
+
+        return entry
+
+    return None
+
+def update_cache_entry(cache_index, file, file_hash, config):
+
+    cache_dir = config['cache_dir']
+
+    key = config['box_file_ids'].get(file, file)
+
+    entry = cache_index.get(key)
+
+    #A changed (or new) wave replaces its previous entry, and the stale cached files are removed
+
+    if entry is None or entry['sha1'] != file_hash:
+
+        if entry is not None:
+
+            for cached_file in [entry['metadata'], entry['data']]:
+
+                if cached_file is not None and os.path.exists(os.path.join(cache_dir, cached_file)):
+
+                    os.remove(os.path.join(cache_dir, cached_file))
+
+        entry = {'file': file, 'sha1': file_hash, 'metadata': None, 'data': None, 'columns': []}
+
+        cache_index[key] = entry
+
+    return entry
+
+def store_cached_metadata(cache_index, file, file_hash, meta, config):
+
+    if not config['use_wave_cache']:
+
+        return
+
+    os.makedirs(config['cache_dir'], exist_ok=True)
+
+    entry = update_cache_entry(cache_index, file, file_hash, config)
+    entry['metadata'] = str(config['box_file_ids'].get(file, file)) + '-' + file_hash + '.meta.pkl'
+
+    with open(os.path.join(config['cache_dir'], entry['metadata']), 'wb') as open_file:
+
+        pickle.dump(meta, open_file)
+
+def load_cached_metadata(entry, config):
+
+    if entry is None or entry['metadata'] is None:
+
+        return None
+
+    with open(os.path.join(config['cache_dir'], entry['metadata']), 'rb') as open_file:
+
+        return pickle.load(open_file)
+
+def store_cached_data(cache_index, file, file_hash, df, config):
+
+    if not config['use_wave_cache']:
+
+        return
+
+    os.makedirs(config['cache_dir'], exist_ok=True)
+
+    entry = update_cache_entry(cache_index, file, file_hash, config)
+
+    #Feather requires pyarrow; without it only metadata is cached
+
+    try:
+
+        data_file = str(config['box_file_ids'].get(file, file)) + '-' + file_hash + '.feather'
+
+        df.reset_index(drop=True).to_feather(os.path.join(config['cache_dir'], data_file))
+
+    except ImportError:
+
+        return
+
+    entry['data'] = data_file
+    entry['columns'] = list(df.columns)
+
+def load_cached_data(entry, columns, config):
+
+    #Cached data is only reusable if it already holds every column the current projection needs
+
+    if entry is None or entry['data'] is None or not set(columns).issubset(entry['columns']):
+
+        return None
+
+    return pd.read_feather(os.path.join(config['cache_dir'], entry['data']), columns=columns)
+
+## -- EXTRACT AND CATALOG METADATA FROM EACH SPSS FILE -- ##    
+
+def extract_metadata(all_original_spss_files, config, preloaded_metadata=None):
+
+    retain_specific_files = config['retain_specific_files']
+
+    #Generate empty dictionaries to house extracted metadata
+    all_column_names_dict = {}
+    all_column_labels_dict = {}
+    all_column_names_to_labels_dict = {}
+    variable_value_labels_dict = {}
+    variable_measure_dict = {}
+    variable_display_width_dict = {}
+    value_labels_dict = {}
+    missing_ranges_dict = {}
+    variable_types_dict = {}
+    number_rows_dict = {}
+
+    #Generate lists of all metadata types/storage vehicles to enable efficient looping later in function
+    all_metadata_types = ['column_names', 'column_labels', 'column_names_to_labels', 'variable_value_labels', 'variable_measure', 'variable_display_width', 'value_labels', 'missing_ranges', 'variable_types', 'number_rows']
+
+    all_metadata_dicts = [all_column_names_dict, all_column_labels_dict, all_column_names_to_labels_dict, variable_value_labels_dict, variable_measure_dict, variable_display_width_dict, value_labels_dict, missing_ranges_dict, variable_types_dict, number_rows_dict]
+
+    #Determine which files should be merged - leaving "retain_particular_files" blank will merge all files in the directory
+
+    if len(retain_specific_files) > 1:
+
+        active_files = [x for x in all_original_spss_files if x in retain_specific_files]
+
+    elif len(retain_specific_files) == 0:
+
+        active_files = all_original_spss_files
+
+    print("Merging " + str(len(active_files)) + " files.")
+
+    #Reuse metadata from the wave cache where the file's contents are unchanged; only new or modified waves are read.  Without the cache no hash is needed at all.
+
+    file_hashes = {file: hash_wave(os.path.join(config['temp_dir'], str(file)), config) if config['use_wave_cache'] else None for file in all_original_spss_files}
+
+    cache_index = load_cache_index(config)
+
+    #Metadata already read while the waves were downloading (see 'pipelined') is used as is, and cached like any other freshly read metadata
+
+    preloaded_metadata = preloaded_metadata or {}
+
+    all_file_metadata = {file: load_cached_metadata(find_cache_entry(cache_index, file, file_hashes[file], config), config) for file in all_original_spss_files}
+
+    fresh_files = [file for file in all_original_spss_files if all_file_metadata[file] is None and file in preloaded_metadata]
+
+    for file in fresh_files:
+
+        all_file_metadata[file] = preloaded_metadata[file]
+
+        store_cached_metadata(cache_index, file, file_hashes[file], preloaded_metadata[file], config)
+
+    uncached_files = [file for file in all_original_spss_files if all_file_metadata[file] is None]
+
+    print("Reusing cached metadata for " + str(len(all_original_spss_files) - len(uncached_files)) + " of " + str(len(all_original_spss_files)) + " files.")
+
+    #Extract metadata using the pyreadstat package
+    for file, meta in zip(uncached_files, read_spss_metadata(uncached_files, config)):
+
+        all_file_metadata[file] = meta
+
+        store_cached_metadata(cache_index, file, file_hashes[file], meta, config)
+
+    save_cache_index(cache_index, config)
+
+    for file in all_original_spss_files:
+
+        meta = all_file_metadata[file]
+
+        #Extract each piece of metadata from the SAV file
+
+        column_names = meta.column_names
+        column_labels = meta.column_labels
+        column_names_to_labels = meta.column_names_to_labels
+
+        variable_value_labels = meta.variable_value_labels
+        variable_measure = meta.variable_measure
+        variable_display_width = meta.variable_display_width
+
+        value_labels = meta.value_labels
+        missing_ranges = meta.missing_ranges
+        variable_types = meta.original_variable_types
+
+        #Store each set of metadata as a dictionary entry, KEYED by file
+
+        all_column_names_dict[file] = column_names
+        all_column_labels_dict[file] = column_labels
+        all_column_names_to_labels_dict[file] = column_names_to_labels
+
+        variable_value_labels_dict[file] = variable_value_labels
+        variable_measure_dict[file] = variable_measure
+        variable_display_width_dict[file] = variable_display_width
+
+        value_labels_dict[file] = value_labels
+        missing_ranges_dict[file] = missing_ranges
+        variable_types_dict[file] = variable_types
+        number_rows_dict[file] = meta.number_rows
+
+    #Create dictionary housing all metadata, KEYED by type, SUB-KEYED by file
+
+    all_original_metadata = {all_metadata_types[i]: all_metadata_dicts[i] for i in range(len(all_metadata_dicts))}
+
+    return all_original_metadata, active_files, file_hashes
+
+## -- BUILD AN INDEXED CATALOGUE OF EVERY VARIABLE ACROSS FILES -- ##
+
+def build_variable_catalogue(all_column_names_dict):
+
+    files = list(all_column_names_dict)
+
+    #Ordered set of variables: dict keys keep first-seen order (parent file first) and give O(1) membership tests, with each variable's row in the presence bitmap as its value
+
+    variable_index = {}
+
+    for file in files:
+
+        for colname in all_column_names_dict[file]:
+
+            variable_index.setdefault(colname, len(variable_index))
+
+    #Presence bitmap: one row per variable, one column per file, True where the variable appears in that file
+
+    presence = np.zeros((len(variable_index), len(files)), dtype=bool)
+
+    for position, file in enumerate(files):
+
+        presence[[variable_index[colname] for colname in all_column_names_dict[file]], position] = True
+
+    return {'variables': list(variable_index), 'index': variable_index, 'files': files, 'presence': presence}
+
+#Inclusion rules are answered from the presence bitmap in one vectorized pass rather than by looping over files
+
+def variables_in_at_least(catalogue, n):
+
+    return [catalogue['variables'][i] for i in np.flatnonzero(catalogue['presence'].sum(axis=1) >= n)]
+
+def variables_in_last(catalogue, k, config, files=None):
+
+    #'Last' is chronological (see chronological_order), not the catalogue's file order, where the parent file always comes first; files limits the candidates (e.g. to the active waves)
+
+    latest_files = chronological_order(catalogue['files'] if files is None else files, config)[-k:]
+
+    positions = [catalogue['files'].index(file) for file in latest_files]
+
+    return [catalogue['variables'][i] for i in np.flatnonzero(catalogue['presence'][:, positions].all(axis=1))]
+
+## -- BASED ON EXPLICIT OVERRIDES & BASELINE CRITERIA, DETERMINE VARIABLE INCLUSION -- ##
+
+def determine_variable_inclusion(extracted_metadata, explicit_overrides, config):
+
+    always_retain = config['always_retain']
+    always_remove = config['always_remove']
+
+    all_column_names_dict = extracted_metadata[0]['column_names']
+
+    variable_catalogue = build_variable_catalogue(all_column_names_dict)
+
+    all_unique_variables = variable_catalogue['variables']
+
+    #Count how frequently each variable appears
+
+    all_variable_instances = dict(zip(all_unique_variables, variable_catalogue['presence'].sum(axis=1).tolist()))
+
+    # Append variables to always_retain / always_remove lists from explicit overrides Google Sheet
+
+    #Overrides arrive compiled (see load_override_rules); a raw overrides dataframe is compiled here
+
+    override_rules = explicit_overrides if isinstance(explicit_overrides, dict) else compile_override_rules(explicit_overrides)
+
+    #always_retain / always_remove are folded into the same rule index
+
+    configured_rules = compile_override_rules(pd.DataFrame({'Force-Include / Force-Exclude': ['FORCE-INCLUDE'] * len(always_retain) + ['FORCE EXCLUDE'] * len(always_remove), 'Variable': always_retain + always_remove}))
+
+    #Force-include, then force-exclude, each decided for every variable at once
+
+    include_mask = match_override_rules(all_unique_variables, override_rules['include']) | match_override_rules(all_unique_variables, configured_rules['include'])
+    exclude_mask = match_override_rules(all_unique_variables, override_rules['exclude']) | match_override_rules(all_unique_variables, configured_rules['exclude'])
+
+    retained_variables = [all_unique_variables[i] for i in np.flatnonzero(include_mask)]
+    removed_variables = [all_unique_variables[i] for i in np.flatnonzero(exclude_mask)]
+
+    return all_unique_variables, retained_variables, removed_variables, all_variable_instances, variable_catalogue
+
+## -- FINGERPRINT METADATA SO WAVES CAN BE GROUPED INSTEAD OF COMPARED PAIRWISE -- ##
+
+def canonicalize_metadata(value):
+
+    #Dicts are sorted by key and numeric keys are normalised (1 and 1.0 are the same SPSS code), so equal metadata always has the same canonical form
+
+    if isinstance(value, dict):
+
+        return tuple(sorted((repr(float(key)) if isinstance(key, (int, float)) else repr(key), canonicalize_metadata(item)) for key, item in value.items()))
+
+    if isinstance(value, (list, tuple)):
+
+        return tuple(canonicalize_metadata(item) for item in value)
+
+    return repr(value)
+
+def fingerprint_metadata(value):
+
+    return hashlib.sha1(repr(canonicalize_metadata(value)).encode()).hexdigest()
+
+def describe_metadata_divergence(reference, value):
+
+    #Value-label dicts are diffed code by code; any other metadata type is reported as a plain change
+
+    if isinstance(reference, dict) and isinstance(value, dict):
+
+        return {'added': [code for code in value if code not in reference],
+            'removed': [code for code in reference if code not in value],
+            'relabelled': [code for code in value if code in reference and value[code] != reference[code]]}
+
+    return {'changed': [reference, value]}
+
+## -- ORGANIZE METADATA OF VARIOUS TYPES INTO A DICTIONARY KEYED BY VARIABLE -- ##
+
+def organize_metadata_by_var(extracted_metadata, variable_inclusion):
+
+    all_unique_variables = variable_inclusion[4]['index'] #Dict lookups keep the membership test below O(1)
+    all_original_metadata = extracted_metadata[0]
+
+    #GROUP METADATA INTO DICTIONARIES KEYED BY COLUMN NAME
+
+    column_names_to_labels_cleaned = {}
+    variable_value_labels_cleaned = {}
+    missing_ranges_cleaned = {}
+    variable_display_width_cleaned = {}
+    variable_measure_cleaned = {}
+
+    inconsistent_column_names_to_labels = {}
+    inconsistent_variable_value_labels = {}
+    inconsistent_missing_ranges = {}
+    inconsistent_variable_display_width = {}
+    inconsistent_variable_measures = {}
+
+    key_metadata_types = {'column_names_to_labels': [column_names_to_labels_cleaned, inconsistent_column_names_to_labels],
+    'variable_value_labels': [variable_value_labels_cleaned, inconsistent_variable_value_labels],
+    'missing_ranges': [missing_ranges_cleaned, inconsistent_missing_ranges],'variable_display_width': [variable_display_width_cleaned, inconsistent_variable_display_width], 'variable_measure': [variable_measure_cleaned, inconsistent_variable_measures]}
+
+    for type in key_metadata_types: #Cycles through metadata type
+
+        full_file_set = all_original_metadata[type]
+
+        #Each wave's metadata is fingerprinted once and waves with identical metadata are grouped, KEYED by variable, SUB-KEYED by fingerprint
+
+        fingerprint_groups = {}
+
+        for file in full_file_set: #Cycles through files
+
+            instance = full_file_set[file]
+
+            for colname in instance: #Cycles through individual variable (column) names within each file
+
+                if colname in all_unique_variables: #If the variable (column) name appears in active unique variables, the corresponding metadata is appended to a cleaned dictionary
+
+                    cleaned_dict = key_metadata_types[type][0]
+
+                    if colname not in cleaned_dict: 
+
+                        cleaned_dict[colname] = [instance[colname]]
+                    
+                    elif colname in cleaned_dict:
+
+                        cleaned_dict[colname].append(instance[colname])    
+
+                    variable_groups = fingerprint_groups.setdefault(colname, {})
+
+                    fingerprint = fingerprint_metadata(instance[colname])
+
+                    if fingerprint not in variable_groups:
+
+                        variable_groups[fingerprint] = {'files': [], 'value': instance[colname]}
+
+                    variable_groups[fingerprint]['files'].append(file)
+
+        #Variables whose waves fall into more than one group are inconsistent.  Groups are kept in order of first appearance, so the group containing the parent file comes first.
+
+        inconsistent_dict = key_metadata_types[type][1]
+
+        for colname, variable_groups in fingerprint_groups.items():
+
+            if len(variable_groups) > 1:
+
+                inconsistent_dict[colname] = list(variable_groups.values())
+
+    return key_metadata_types
+
+## -- DETECT INCONSISTENCIES BETWEEN FILES IN SPECIFIC VARIABLES; STAGE FOR EXCLUSION -- ##
+
+def find_inconsistent_variables(key_metadata_types, variable_inclusion):
+
+    always_retain = variable_inclusion[1]
+
+    #FIND ACTIVE VARIABLES WITH INCONSISTENT METADATA
+
+    inconsistent_variables = []
+
+    #Inconsistencies are read from the fingerprint groups built in organize_metadata_by_var, so no metadata is compared here
+
+    #Code in function below (doesn't run by default) detects variables with a change in any type of metadata (col labels, var-val labels, var measures, var widths)
+
+    def detect_all_inconsistencies(key_metadata_types):
+
+        for type in key_metadata_types:
+
+            inconsistent_variables.extend(key_metadata_types[type][1])
+
+        return inconsistent_variables
+
+    #Detects column label inconsistencies only; runs by default for awareness, but doesn't actually exclude variables by default
+    
+    def detect_col_label_inconsistencies(key_metadata_types):
+
+        return list(key_metadata_types['column_names_to_labels'][1])
+
+    inconsistent_column_labels = detect_col_label_inconsistencies(key_metadata_types)
+
+    #Code in function below (runs by default) detects inconsistencies in var-val-labels ONLY, which is the most consequential type of metadata inconsistency
+
+    def detect_critical_inconsistencies(key_metadata_types):
+
+        inconsistent_variables.extend(key_metadata_types['variable_value_labels'][1])
+
+        return inconsistent_variables
+
+    inconsistent_variables = detect_critical_inconsistencies(key_metadata_types)
+
+    #Report which waves diverge from the group containing the parent file, and how
+
+    divergence_report = {}
+
+    for type in key_metadata_types:
+
+        for variable, variable_groups in key_metadata_types[type][1].items():
+
+            reference = variable_groups[0]
+
+            divergence_report.setdefault(type, {})[variable] = [{'reference_files': reference['files'], 'files': group['files'], 'divergence': describe_metadata_divergence(reference['value'], group['value'])} for group in variable_groups[1:]]
+
+    #Find inconsistent variables that will indeed be included (those that are force-included)
+
+    inconsistent_variables = set(inconsistent_variables)
+
+    print("Variables with inconsistent metadata: " + str(len(inconsistent_variables)))
+
+    for i in inconsistent_variables:
+
+        print(i)
+
+        for divergence in divergence_report.get('variable_value_labels', {}).get(i, []):
+
+            print("    " + str(divergence['files']) + ": " + str(divergence['divergence']))
+
+    included_inconsistent_variables = []
+
+    for var in always_retain:
+
+        if var in inconsistent_variables:
+
+            included_inconsistent_variables.append(var)
+
+    print("WARNING - the following variables with inconsistent metadata are included in the dataframe: " + str(included_inconsistent_variables) + ".  Be sure to over-write metadata entries for each of these variables at the end of the script if needed." )
+
+    return inconsistent_variables, inconsistent_column_labels, divergence_report
+
+## -- RECONCILE VALUE LABELS THAT DIFFER BETWEEN WAVES -- ##
+
+#Each strategy works on the fingerprint groups from organize_metadata_by_var (one label table per distinct set of labels, the parent file's group first), so the cost grows with the number of distinct label sets rather than with pairs of waves
+
+def normalize_label(label):
+
+    return ' '.join(str(label).split()).casefold()
+
+def reconcile_union(variable_groups):
+
+    #Every code from every wave is labelled; where waves label one code differently, the first (parent) label is kept and the code is reported
+
+    value_labels = dict(variable_groups[0]['value'])
+
+    conflicts = []
+
+    for group in variable_groups[1:]:
+
+        for code, label in group['value'].items():
+
+            if code not in value_labels:
+
+                value_labels[code] = label
+
+            elif normalize_label(value_labels[code]) != normalize_label(label):
+
+                conflicts.append(code)
+
+    return {'value_labels': value_labels, 'recodes': [], 'conflicts': sorted(set(conflicts), key=str)}
+
+def reconcile_parent_wins(variable_groups):
+
+    #The parent file's labels are used as they are; codes only other waves use stay in the data unlabelled
+
+    value_labels = dict(variable_groups[0]['value'])
+
+    conflicts = [code for group in variable_groups[1:] for code, label in group['value'].items() if code not in value_labels or normalize_label(value_labels[code]) != normalize_label(label)]
+
+    return {'value_labels': value_labels, 'recodes': [], 'conflicts': sorted(set(conflicts), key=str)}
+
+def reconcile_recode_to_parent(variable_groups):
+
+    #Codes are matched to the parent's codes by label text.  A label the parent lacks keeps its code if that code is free, and is otherwise moved to a new code past the highest one in use; the resulting remapping table is applied to the wave's data.
+
+    value_labels = dict(variable_groups[0]['value'])
+
+    codes_by_label = {normalize_label(label): code for code, label in value_labels.items()}
+
+    all_codes = [code for group in variable_groups for code in group['value']]
+
+    if not all(isinstance(code, (int, float)) for code in all_codes):
+
+        return reconcile_union(variable_groups) #Text codes cannot be renumbered
+
+    next_code = max(all_codes) + 1
+
+    recodes = []
+
+    for group in variable_groups[1:]:
+
+        mapping = {}
+
+        for code, label in group['value'].items():
+
+            key = normalize_label(label)
+
+            if key in codes_by_label:
+
+                target = codes_by_label[key]
+
+            else:
+
+                target = code if code not in value_labels else next_code
+
+                next_code = max(next_code, target + 1)
+
+                value_labels[target] = label
+                codes_by_label[key] = target
+
+            if target != code:
+
+                mapping[code] = target
+
+        if mapping:
+
+            recodes.append({'files': group['files'], 'mapping': mapping})
+
+    return {'value_labels': value_labels, 'recodes': recodes, 'conflicts': []}
+
+label_reconcilers = {'union': reconcile_union, 'parent-wins': reconcile_parent_wins, 'recode-to-parent': reconcile_recode_to_parent}
+
+def reconcile_value_labels(key_metadata_types, inconsistencies, config):
+
+    label_reconciliation = {}
+
+    for var, variable_groups in key_metadata_types['variable_value_labels'][1].items():
+
+        strategy = config['label_strategies'].get(var, config['label_strategy'])
+
+        if strategy == 'drop':
+
+            continue
+
+        if strategy not in label_reconcilers:
+
+            raise ValueError("Unknown label strategy for " + var + ": " + str(strategy))
+
+        label_reconciliation[var] = dict(label_reconcilers[strategy](variable_groups), strategy=strategy)
+
+    recoded_variables = [var for var, reconciled in label_reconciliation.items() if reconciled['recodes']]
+
+    print("Reconciled value labels for " + str(len(label_reconciliation)) + " of " + str(len(inconsistencies[0])) + " inconsistent variables (" + str(len(recoded_variables)) + " recoded to the parent's codes).")
+
+    for var, reconciled in label_reconciliation.items():
+
+        if reconciled['conflicts']:
+
+            print("    " + var + " (" + reconciled['strategy'] + "): conflicting labels for codes " + str(reconciled['conflicts']))
+
+    config['run_report']['label_reconciliation'] = {var: {'strategy': reconciled['strategy'], 'recoded_waves': sum(len(recode['files']) for recode in reconciled['recodes']), 'conflicts': [str(code) for code in reconciled['conflicts']]} for var, reconciled in label_reconciliation.items()}
+
+    return label_reconciliation
+
+## -- DETERMINE WHICH COLUMNS TO READ FROM EACH FILE -- ##
+
+def determine_kept_columns(extracted_metadata, inconsistencies, variable_inclusion, config):
+
+    all_column_names_dict = extracted_metadata[0]['column_names']
+    active_files = extracted_metadata[1]
+    inconsistent_variables = set(inconsistencies[0])
+
+    retained = set(variable_inclusion[1])
+    removed = set(variable_inclusion[2])
+
+    #Variables that appear in too few files are excluded (see min_wave_appearances)
+
+    frequent_variables = set(variables_in_at_least(variable_inclusion[4], config['min_wave_appearances']))
+
+    #Variables missing from any of the most recent waves are excluded too (see min_recent_waves)
+
+    if config['min_recent_waves'] > 0:
+
+        frequent_variables &= set(variables_in_last(variable_inclusion[4], config['min_recent_waves'], config, active_files))
+
+    kept_columns = {}
+
+    for file in active_files:
+
+        kept_columns[file] = [col for col in all_column_names_dict[file]
+            if not (col in inconsistent_variables and col not in retained) #inconsistent metadata
+            and col in frequent_variables #column appears in too few files, or not in the most recent ones
+            and col not in removed]
+
+    return kept_columns
+
+## -- DETERMINE FINAL COLUMN ORDER OF THE MERGED DATASET -- ##
+
+def determine_final_columns(active_files, kept_columns):
+
+    #Columns appear in the order they are first seen (parent file first), matching pd.concat; 'wave' is always last
+
+    final_columns = {}
+
+    for file in active_files:
+
+        for col in kept_columns[file]:
+
+            final_columns[col] = None
+
+    return list(final_columns) + ['wave']
+
+## -- PLAN THE MERGED SCHEMA FROM METADATA BEFORE ANY DATA IS READ -- ##
+
+def plan_merge_schema(extracted_metadata, key_metadata_types, inconsistencies, variable_inclusion, config, label_reconciliation=None):
+
+    label_reconciliation = label_reconciliation or {}
+
+    all_original_metadata = extracted_metadata[0]
+    active_files = extracted_metadata[1]
+
+    kept_columns = determine_kept_columns(extracted_metadata, inconsistencies, variable_inclusion, config)
+    final_columns = determine_final_columns(active_files, kept_columns)
+
+    variables = resolve_variable_metadata(all_original_metadata, active_files, final_columns, label_reconciliation, config)
+
+    #'wave' is added during the merge, so it has no entry in the original metadata
+
+    variables['wave'] = {'label': 'Wave', 'type': 'A' + str(max([len(str(file)) for file in active_files] + [1])), 'fill': 'blank'}
+
+    #Each wave's columns map to fixed positions in the final layout; anything else is filled per the variable's fill rule
+
+    column_positions = {col: position for position, col in enumerate(final_columns)}
+
+    waves = {}
+
+    for file in active_files:
+
+        waves[file] = {'rows': all_original_metadata['number_rows'][file],
+            'positions': [column_positions[col] for col in kept_columns[file]]}
+
+    #Label recodes compile to the same lookup-array rules as the Mongo reclassifications, so they are applied to each wave with np.take
+
+    recode_documents = [{'variable': var, 'mapping': {str(code): target for code, target in recode['mapping'].items()}, 'files': recode['files']} for var, reconciled in label_reconciliation.items() if var in variables for recode in reconciled['recodes']]
+
+    schema_plan = {'columns': final_columns, 'kept_columns': kept_columns, 'variables': variables, 'waves': waves, 'recodes': compile_reclassifications(recode_documents), 'rows': sum(wave['rows'] or 0 for wave in waves.values())}
+
+    schema_plan['estimate'] = estimate_merge_size(schema_plan, config)
+
+    config['run_report']['plan'] = dict(schema_plan['estimate'], columns=len(final_columns), rows=schema_plan['rows'])
+
+    print("Planned merge: " + str(schema_plan['rows']) + " rows x " + str(len(final_columns)) + " columns; estimated " + str(schema_plan['estimate']['merged_mb']) + " MB in memory, " + str(schema_plan['estimate']['sav_mb']) + " MB as SAV.")
+
+    return schema_plan
+
+#Plan keys of the per-variable metadata, by the metadata type they are read from
+
+variable_metadata_types = {'column_names_to_labels': 'label', 'variable_value_labels': 'value_labels', 'variable_measure': 'measure', 'variable_display_width': 'display_width', 'variable_types': 'type'}
+
+def resolve_variable_metadata(all_original_metadata, active_files, final_columns, label_reconciliation, config):
+
+    if config['metadata_precedence'] not in ['parent', 'latest']:
+
+        raise ValueError("Unknown metadata precedence: " + str(config['metadata_precedence']))
+
+    #Each type is resolved for every variable at once by layering the waves' metadata dicts from lowest to highest precedence, so the winning wave's entry is the one left standing.  Types are resolved independently: a variable without value labels still keeps its measure and width.  'latest' follows the chronological wave order, in which the parent file can be the newest wave.
+
+    source_files = chronological_order(active_files, config) if config['metadata_precedence'] == 'latest' else list(reversed(active_files))
+
+    variables = {var: {} for var in final_columns[:-1]}
+
+    for type, key in variable_metadata_types.items():
+
+        resolved = {}
+
+        for file in source_files:
+
+            resolved.update(all_original_metadata[type][file])
+
+        for var in variables.keys() & resolved.keys():
+
+            variables[var][key] = resolved[var]
+
+    #Value labels reconciled across waves (see reconcile_value_labels) replace any single wave's labels; explicit overrides win over both
+
+    for var, reconciled in label_reconciliation.items():
+
+        if var in variables:
+
+            variables[var]['value_labels'] = reconciled['value_labels']
+
+    for var, override in config['metadata_overrides'].items():
+
+        unknown_keys = set(override) - {'label', 'value_labels', 'measure', 'display_width'}
+
+        if unknown_keys:
+
+            raise ValueError("Unknown metadata override for " + var + ": " + str(sorted(unknown_keys)))
+
+        if var not in variables:
+
+            print("Metadata override for " + var + " ignored; the variable is not in the merged dataset.")
+
+            continue
+
+        variables[var].update(override)
+
+    for var, variable in variables.items():
+
+        #SPSS format strings: 'A<width>' is text, anything else (F8.2, DATE11, ...) is numeric
+
+        variable.setdefault('type', 'F8.2')
+
+        #Fill rule for waves that lack the variable: system-missing for numerics, blank for text
+
+        variable['fill'] = 'blank' if variable['type'].startswith('A') else 'system-missing'
+
+    return variables
+
+def estimate_merge_size(schema_plan, config):
+
+    merged_bytes = 0
+    sav_bytes = 0
+
+    for var, variable in schema_plan['variables'].items():
+
+        width = int(''.join(char for char in variable['type'][1:] if char.isdigit()) or 8) if variable['type'].startswith('A') else 8
+
+        #SAV stores numerics in 8 bytes and text in 8-byte segments; in memory, narrowed labelled codes take about 2 bytes (value plus mask), categoricals 1, other numerics 8 and unnarrowed text a pointer plus the string
+
+        sav_bytes += 8 if not variable['type'].startswith('A') else -(-width // 8) * 8
+
+        if config['narrow_dtypes'] and (var == 'wave' or 'value_labels' in variable):
+
+            merged_bytes += 1 if variable['type'].startswith('A') else 2
+
+        else:
+
+            merged_bytes += 8 + (49 + width if variable['type'].startswith('A') else 0)
+
+    rows = schema_plan['rows']
+
+    return {'merged_mb': round(merged_bytes * rows / 1e6, 1), 'sav_mb': round(sav_bytes * rows / 1e6, 1)}
+
+#dtype of the missing values each fill rule produces when no other wave gives the column a dtype
+
+fill_dtypes = {'system-missing': 'float64', 'blank': 'object'}
+
+def fit_wave_to_schema(df, file, schema_plan, column_dtypes):
+
+    #Each kept column goes straight to its planned slot; the slots left empty are filled per the variable's fill rule, with missing values of the dtype the column has in the other waves, so narrowed and categorical columns are not widened by a float NaN fill.  Every wave then has the planned layout and they concatenate block by block without reindexing.
+
+    columns = schema_plan['columns']
+
+    slots = [None] * len(columns)
+
+    for col, position in zip(schema_plan['kept_columns'][file], schema_plan['waves'][file]['positions']):
+
+        slots[position] = df[col]
+
+    slots[-1] = df['wave']
+
+    for position, col in enumerate(columns):
+
+        if slots[position] is None:
+
+            slots[position] = pd.Series(index=df.index, dtype=column_dtypes.get(col, fill_dtypes[schema_plan['variables'][col]['fill']]))
+
+    return pd.DataFrame(dict(zip(columns, slots)), index=df.index)
+
+## -- READ, PROJECT AND NARROW A SET OF ACTIVE WAVES -- ##
+
+def load_projected_waves(files, schema_plan, extracted_metadata, config, read_pool=None):
+
+    active_files = extracted_metadata[1]
+
+    kept_columns = schema_plan['kept_columns']
+
+    #Exctract CSV Data from SAV files - waves whose projected columns are already in the wave cache are loaded from there instead
+
+    file_hashes = extracted_metadata[2]
+
+    with cache_index_lock:
+
+        cache_index = load_cache_index(config)
+
+    all_extracted_csv_files = [load_cached_data(find_cache_entry(cache_index, file, file_hashes[file], config), kept_columns[file], config) for file in files]
+
+    uncached_files = [file for file, df in zip(files, all_extracted_csv_files) if df is None]
+
+    print("Reusing cached data for " + str(len(files) - len(uncached_files)) + " of " + str(len(files)) + " files.")
+
+    uncached_data = read_spss_files(uncached_files, config, usecols=[kept_columns[file] for file in uncached_files], executor=read_pool)
+
+    for file, (df, meta) in zip(uncached_files, uncached_data):
+
+        all_extracted_csv_files[files.index(file)] = df
+
+    #The index is reloaded before the new entries are added, so entries saved meanwhile by other threads are kept
+
+    with cache_index_lock:
+
+        cache_index = load_cache_index(config)
+
+        for file, (df, meta) in zip(uncached_files, uncached_data):
+
+            store_cached_data(cache_index, file, file_hashes[file], df, config)
+
+        save_cache_index(cache_index, config)
+
+    #Recodes run on the raw values, after caching (so the cache never holds stale recodes) and before narrowing (so recoded values are narrowed like any other).  Label recodes come first, so Mongo rules always see the parent's codes.
+
+    for file, df in zip(files, all_extracted_csv_files):
+
+        apply_reclassifications(df, file, schema_plan['recodes'])
+        apply_reclassifications(df, file, config['reclassifications'])
+
+    #Narrow each wave before concatenating, so the merged frame is never built at full width
+
+    if config['narrow_dtypes']:
+
+        variable_value_labels_dict = extracted_metadata[0]['variable_value_labels']
+
+        all_extracted_csv_files = [narrow_wave_dtypes(df, variable_value_labels_dict[file]) for file, df in zip(files, all_extracted_csv_files)]
+
+    #Append 'wave' column to enable filtering/display over time - as a categorical, each row stores a small integer code rather than a repeated file name
+
+    for file, df in zip(files, all_extracted_csv_files):
+
+        df['wave'] = pd.Categorical.from_codes(np.full(len(df), active_files.index(file)), categories=active_files) if config['narrow_dtypes'] else file
+
+    return all_extracted_csv_files
+
+## -- CONSTRUCT CSV FOR ACTIVE, CONSISTENT VARIABLES -- ##
+
+def construct_csv(extracted_metadata, schema_plan, config):
+
+    active_files = extracted_metadata[1]
+
+    #Columns are dropped at read time via usecols, so inconsistent, singleton and always_remove variables are never decoded
+
+    all_extracted_csv_files = align_categories(load_projected_waves(active_files, schema_plan, extracted_metadata, config))
+
+    column_dtypes = {}
+
+    for df in all_extracted_csv_files:
+
+        for col, dtype in df.dtypes.items():
+
+            column_dtypes.setdefault(col, dtype)
+
+    #Concatenate trimmed dataframes into one; each is already in the planned column order, with 'wave' (and any force-included inconsistent variables) at the end
+
+    full_dataframe = pd.concat([fit_wave_to_schema(df, file, schema_plan, column_dtypes) for file, df in zip(active_files, all_extracted_csv_files)], keys = active_files)
+
+    print("Merged dataframe memory: " + str(round(full_dataframe.memory_usage(deep=True).sum() / 1e6, 1)) + " MB (planned " + str(schema_plan['estimate']['merged_mb']) + " MB)")
+
+    return full_dataframe
+
+## -- NARROW COLUMN DTYPES WHILE MERGING -- ##
+
+def narrow_wave_dtypes(df, variable_value_labels):
+
+    for col in df.columns:
+
+        values = df[col]
+
+        #pyreadstat returns every numeric code as float64.  Labelled codes that are all whole numbers are stored in the smallest nullable integer type instead, with pd.NA marking missing values.
+
+        if col in variable_value_labels and pd.api.types.is_float_dtype(values):
+
+            codes = values.to_numpy()
+            present = codes[~np.isnan(codes)]
+
+            if not np.array_equal(present, np.round(present)):
+
+                continue
+
+            low, high = (present.min(), present.max()) if present.size else (0, 0)
+
+            for dtype in ['int8', 'int16', 'int32']:
+
+                if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+
+                    df[col] = values.astype(dtype.capitalize())
+
+                    break
+
+        #Repetitive text answers are interned as categoricals, so each distinct string is stored once
+
+        elif pd.api.types.is_string_dtype(values) and values.nunique() * 2 <= len(values):
+
+            df[col] = values.astype('category')
+
+    return df
+
+def align_categories(all_extracted_csv_files):
+
+    #pd.concat only keeps a categorical dtype when every wave has identical categories, so each categorical column is given the union of its categories across waves
+
+    categories = {}
+
+    for df in all_extracted_csv_files:
+
+        for col in df.columns:
+
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+
+                categories.setdefault(col, {}).update(dict.fromkeys(df[col].cat.categories))
+
+    for df in all_extracted_csv_files:
+
+        for col, union in categories.items():
+
+            if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype):
+
+                df[col] = df[col].cat.set_categories(list(union))
+
+    return all_extracted_csv_files
+
+## -- MEMORY-MAPPED COLUMNAR STORE BETWEEN THE READ AND WRITE STAGES -- ##
+
+def build_columnar_store(extracted_metadata, schema_plan, config):
+
+    active_files = extracted_metadata[1]
+
+    kept_columns = schema_plan['kept_columns']
+
+    store_dir = prepare_columnar_store(config)
+
+    #Waves are read a pool's worth at a time and each one is written to its own Arrow IPC file once, so at most read_workers waves are held in RAM
+
+    batch_size = max(config['read_workers'], 1)
+
+    store_paths = []
+
+    for start in range(0, len(active_files), batch_size):
+
+        files = active_files[start:start + batch_size]
+
+        for file, df in zip(files, load_projected_waves(files, schema_plan, extracted_metadata, config)):
+
+            store_paths.append(write_columnar_wave(df, os.path.join(store_dir, str(active_files.index(file)).zfill(4) + '.arrow')))
+
+    return store_paths, schema_plan['columns']
+
+def prepare_columnar_store(config):
+
+    #Kept out of temp_dir, which list_spss_items prunes down to the files in the Box folder
+
+    store_dir = os.path.join(config['cache_dir'], 'store')
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.makedirs(store_dir)
+
+    return store_dir
+
+def write_columnar_wave(df, path):
+
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    with pa.OSFile(path, 'wb') as sink:
+
+        with pa.ipc.new_file(sink, table.schema) as writer:
+
+            writer.write_table(table)
+
+    return path
+
+def open_columnar_store(columnar_store):
+
+    import pyarrow as pa
+
+    store_paths, final_columns = columnar_store
+
+    #Memory-mapped reads are zero-copy: the merged table's buffers point into the page cache rather than into process memory, and the Parquet output is written from it directly.  The SAV and CSV writers still need a pandas frame (see columnar_store_to_dataframe), which prepare_dataframe_for_sav partly copies again, so a run needs RAM for roughly twice the merged frame (the plan's merged_mb) - the columnar store bounds memory while the waves are read, not while the outputs are written.
+
+    tables = [pa.ipc.open_file(pa.memory_map(path, 'r')).read_all() for path in store_paths]
+
+    tables = decode_mismatched_dictionaries(tables)
+
+    #'permissive' promotion fills columns missing from a wave with nulls and widens narrowed integers where waves differ (e.g. int8 and int16)
+
+    merged_table = pa.concat_tables(tables, promote_options='permissive')
+
+    return merged_table.select(final_columns)
+
+def decode_mismatched_dictionaries(tables):
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    #Each wave is written before the next is read, so a text column can be categorical (dictionary-encoded) in a wave with repetitive answers and plain in another (see narrow_wave_dtypes), or use a wider dictionary index.  Arrow cannot merge those types, so such columns are decoded to plain values in every wave; columns with one type across waves keep their encoding.
+
+    column_types = {}
+
+    for table in tables:
+
+        for field in table.schema:
+
+            column_types.setdefault(field.name, set()).add(field.type)
+
+    mismatched = {col for col, types in column_types.items() if len(types) > 1 and any(pa.types.is_dictionary(type) for type in types)}
+
+    decoded_tables = []
+
+    for table in tables:
+
+        for position, field in enumerate(table.schema):
+
+            if field.name in mismatched and pa.types.is_dictionary(field.type):
+
+                table = table.set_column(position, field.name, pc.cast(table.column(position), field.type.value_type))
+
+        decoded_tables.append(table)
+
+    return decoded_tables
+
+def columnar_store_to_dataframe(merged_table):
+
+    import pyarrow as pa
+
+    #Integer columns map back to pandas' nullable types, so narrowed codes with missing values are not silently widened to float64 here
+
+    integer_types = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype()}
+
+    full_dataframe = merged_table.to_pandas(types_mapper=integer_types.get)
+
+    print("Merged dataframe memory: " + str(round(full_dataframe.memory_usage(deep=True).sum() / 1e6, 1)) + " MB")
+
+    return full_dataframe
+
+## -- STREAM ACTIVE, CONSISTENT VARIABLES INTO THE MERGED CSV CHUNK BY CHUNK -- ##
+
+def stream_merged_csv(extracted_metadata, schema_plan, config, path=None):
+
+    import pyreadstat
+
+    if path is None:
+
+        path = config['final_csv_path']
+
+    active_files = extracted_metadata[1]
+
+    kept_columns = schema_plan['kept_columns']
+    final_columns = schema_plan['columns']
+
+    #Each chunk is aligned to the final column schema and appended, so only one chunk is ever held in memory
+
+    total_rows = 0
+
+    with open_csv_output(path) as open_file:
+
+        for file in active_files:
+
+            for chunk, meta in pyreadstat.read_file_in_chunks(pyreadstat.read_sav, os.path.join(config['temp_dir'], str(file)), chunksize=config['chunk_size'], usecols=kept_columns[file]):
+
+                chunk['wave'] = file
+
+                apply_reclassifications(chunk, file, schema_plan['recodes'])
+                apply_reclassifications(chunk, file, config['reclassifications'])
+
+                chunk = fit_wave_to_schema(chunk, file, schema_plan, {})
+
+                chunk.to_csv(open_file, header=(total_rows == 0), index=False)
+
+                total_rows += len(chunk)
+
+    print("STREAMED DATAFRAME: " + str((total_rows, len(final_columns))))
+
+    return total_rows
+
+## -- WRITE THE MERGED DATASET IN EVERY REQUESTED FORMAT -- ##
+
+def open_csv_output(path):
+
+    #The CSV is gzipped whenever its path ends in '.gz'; the handle stays open across chunks so the output is a single compressed stream
+
+    if path.endswith('.gz'):
+
+        return gzip.open(path, 'wt', newline='', compresslevel=6)
+
+    return open(path, 'w', newline='')
+
+def write_sav_output(sav_dataframe, spss_metadata, path):
+
+    import pyreadstat
+
+    #The metadata has already been checked and coerced against the frame (see validate_spss_metadata), so it is handed over as is: column labels as a list aligned with the planned column order rather than a dict pyreadstat would look up column by column
+
+    pyreadstat.write_sav(sav_dataframe, path, column_labels=list(spss_metadata['column_labels'].values()), variable_value_labels=spss_metadata['variable_value_labels'], variable_measure=spss_metadata['variable_measure'], variable_display_width=spss_metadata['variable_display_width'])
+
+    return len(sav_dataframe)
+
+def write_csv_output(sav_dataframe, path, chunk_size):
+
+    #Written chunk_size rows at a time, so formatting never builds the whole CSV text in memory
+
+    with open_csv_output(path) as open_file:
+
+        for start in range(0, max(len(sav_dataframe), 1), chunk_size):
+
+            sav_dataframe.iloc[start:start + chunk_size].to_csv(open_file, header=(start == 0), index=False)
+
+    return len(sav_dataframe)
+
+def write_parquet_output(merged_dataset, spss_metadata, path):
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = list(spss_metadata['column_labels'])
+
+    #A columnar merge hands over its memory-mapped Arrow table directly; otherwise the narrowed (not SAV-widened) dataframe is converted, so categoricals and nullable codes keep their compact types
+
+    if isinstance(merged_dataset, pa.Table):
+
+        table = merged_dataset.select(columns)
+
+    else:
+
+        merged_dataset = merged_dataset.reset_index(drop=True)[columns]
+
+        #Arrow needs one type per column, so mixed numeric/text columns are stored as text, as in the SAV
+
+        for col in merged_dataset.columns[merged_dataset.dtypes == object]:
+
+            merged_dataset[col] = merged_dataset[col].astype(str).where(merged_dataset[col].notna())
+
+        table = pa.Table.from_pandas(merged_dataset, preserve_index=False)
+
+    #SPSS labels travel in the schema metadata as JSON (value label codes become strings), next to the pandas metadata Arrow already stores
+
+    labels = {'column_labels': spss_metadata['column_labels'],
+        'variable_value_labels': {var: {str(code): label for code, label in value_labels.items()} for var, value_labels in spss_metadata['variable_value_labels'].items()},
+        'variable_measure': spss_metadata['variable_measure'],
+        'variable_display_width': spss_metadata['variable_display_width']}
+
+    table = table.replace_schema_metadata(dict(table.schema.metadata or {}, spss=json.dumps(labels)))
+
+    pq.write_table(table, path)
+
+    return table.num_rows
+
+def write_output(config, output_format, path, writer, *args):
+
+    start = time.perf_counter()
+
+    rows = writer(*args)
+
+    seconds = time.perf_counter() - start
+
+    size = os.path.getsize(path)
+
+    output = {'format': output_format, 'path': path, 'rows': rows, 'bytes': size, 'seconds': round(seconds, 3), 'mb_per_second': round(size / 1e6 / max(seconds, 1e-3), 1), 'rows_per_second': round(rows / max(seconds, 1e-3))}
+
+    config['run_report']['outputs'].append(output)
+
+    print("OUTPUT " + output_format + ": " + str(output['seconds']) + "s, " + str(output['mb_per_second']) + " MB/s -> " + path)
+
+    return output
+
+def write_outputs(merged_dataset, sav_dataframe, spss_metadata, config, on_written=None):
+
+    #Every format is written from the same merged data in its own thread; pyarrow releases the GIL while encoding Parquet, so that format overlaps the SAV and CSV writes rather than following them
+
+    writers = {'sav': (config['final_sav_path'], write_sav_output, sav_dataframe, spss_metadata, config['final_sav_path']),
+        'csv': (config['final_csv_path'], write_csv_output, sav_dataframe, config['final_csv_path'], config['chunk_size']),
+        'parquet': (config['final_parquet_path'], write_parquet_output, merged_dataset, spss_metadata, config['final_parquet_path'])}
+
+    unknown_formats = set(config['output_formats']) - set(writers)
+
+    if unknown_formats:
+
+        raise ValueError("Unknown output formats: " + str(sorted(unknown_formats)))
+
+    with ThreadPoolExecutor(max_workers=max(len(config['output_formats']), 1)) as executor:
+
+        futures = [executor.submit(write_output, config, output_format, *writers[output_format]) for output_format in config['output_formats']]
+
+        #on_written is called as each format finishes (in completion order), e.g. to start uploading it while the others are still being written
+
+        if on_written is not None:
+
+            for future in as_completed(futures):
+
+                on_written(future.result())
+
+        return [future.result() for future in futures]
+
+## -- PREPARE MERGED DATAFRAME FOR PYREADSTAT -- ##
+
+def prepare_dataframe_for_sav(full_dataframe):
+
+    #pd.concat(keys=...) leaves a (file, row) MultiIndex; SPSS files have no index, so it is dropped here rather than surfacing as 'Unnamed' columns
+
+    full_dataframe = full_dataframe.reset_index(drop=True)
+
+    for col in full_dataframe.columns:
+
+        values = full_dataframe[col]
+
+        #Narrowed columns (see narrow_wave_dtypes) are re-widened to the float64/text types pyreadstat writes
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+
+            values = values.astype(object)
+
+        elif pd.api.types.is_extension_array_dtype(values) and pd.api.types.is_integer_dtype(values):
+
+            full_dataframe[col] = values.to_numpy(dtype='float64', na_value=np.nan)
+
+        #A variable that is numeric in some waves and text in others arrives as a mixed object column; write it as text, leaving missing values blank
+
+        if pd.api.types.is_object_dtype(values):
+
+            full_dataframe[col] = values.astype(str).where(values.notna(), '')
+
+    return full_dataframe
+
+## -- VALIDATE FINAL METADATA AGAINST THE MERGED DATAFRAME -- ##
+
+valid_measures = ['nominal', 'ordinal', 'scale', 'unknown']
+
+#Python types pyreadstat accepts as value label codes for each kind of column
+
+accepted_code_types = {'integer': (int,), 'double': (int, float), 'text': (str,)}
+
+def coerce_value_label_code(code, kind):
+
+    #pyreadstat requires codes of exactly these types (a numpy float64 code is rejected), so anything else is converted: text columns take the code as text, numeric columns a whole number as int
+
+    if type(code) in accepted_code_types[kind]:
+
+        return code
+
+    if kind == 'text':
+
+        return str(code)
+
+    code = float(code)
+
+    if code.is_integer():
+
+        return int(code)
+
+    if kind == 'integer':
+
+        raise ValueError(code)
+
+    return code
+
+def validate_spss_metadata(sav_dataframe, spss_metadata, config):
+
+    #pyreadstat checks labels while it writes, after the data pass has started, and stops at the first bad entry; every entry is checked here once instead, repaired where the intent is clear and dropped otherwise, so the write itself cannot fail on metadata
+
+    report = {'unlabelled': [], 'labels_coerced': [], 'value_labels_coerced': [], 'value_labels_dropped': [], 'measures_dropped': [], 'widths_dropped': []}
+
+    kinds = {}
+
+    for col, dtype in sav_dataframe.dtypes.items():
+
+        kinds[col] = 'integer' if pd.api.types.is_integer_dtype(dtype) else 'double' if pd.api.types.is_numeric_dtype(dtype) else 'text'
+
+    column_labels = {}
+
+    for var, label in spss_metadata['column_labels'].items():
+
+        if label is None or isinstance(label, str):
+
+            column_labels[var] = label
+
+        else:
+
+            column_labels[var] = str(label)
+
+            report['labels_coerced'].append(var)
+
+        if label is None:
+
+            report['unlabelled'].append(var)
+
+    variable_value_labels = {}
+
+    for var, value_labels in spss_metadata['variable_value_labels'].items():
+
+        if var not in kinds or not value_labels:
+
+            continue
+
+        kind = kinds[var]
+
+        try:
+
+            coerced = {coerce_value_label_code(code, kind): str(label) for code, label in value_labels.items()}
+
+        except (TypeError, ValueError):
+
+            report['value_labels_dropped'].append(var)
+
+            continue
+
+        if any(type(code) not in accepted_code_types[kind] for code in value_labels) or any(not isinstance(label, str) for label in value_labels.values()):
+
+            report['value_labels_coerced'].append(var)
+
+        variable_value_labels[var] = coerced
+
+    variable_measure = {}
+
+    for var, measure in spss_metadata['variable_measure'].items():
+
+        if measure in valid_measures:
+
+            variable_measure[var] = measure
+
+        else:
+
+            report['measures_dropped'].append(var)
+
+    variable_display_width = {}
+
+    for var, width in spss_metadata['variable_display_width'].items():
+
+        try:
+
+            variable_display_width[var] = int(width)
+
+        except (TypeError, ValueError):
+
+            report['widths_dropped'].append(var)
+
+    config['run_report']['metadata_validation'] = dict(report, precedence=config['metadata_precedence'], overridden=sorted(set(config['metadata_overrides']) & set(column_labels)))
+
+    problems = {check: variables for check, variables in report.items() if variables and check != 'unlabelled'}
+
+    print("Validated metadata for " + str(len(column_labels)) + " variables (" + str(len(report['unlabelled'])) + " without a column label).")
+
+    for check, variables in problems.items():
+
+        print("    " + check.replace('_', ' ') + ": " + ', '.join(variables[:10]) + (' ...' if len(variables) > 10 else ''))
+
+    return {'column_labels': column_labels, 'variable_value_labels': variable_value_labels, 'variable_measure': variable_measure, 'variable_display_width': variable_display_width}
+
+## -- CREATE MERGED SPSS FILE -- ##
+
+def create_spss_file(full_dataframe, schema_plan, key_metadata_types, inconsistencies, config, merged_table=None, on_written=None):
+
+    inconsistent_column_labels = inconsistencies[1]
+    column_names_to_labels_cleaned = key_metadata_types['column_names_to_labels'][0]
+
+    #Final metadata comes straight from the schema plan, in the planned column order
+
+    variables = schema_plan['variables']
+
+    final_col_labels_key = schema_plan['columns']
+    final_col_labels = [variables[var].get('label') for var in final_col_labels_key]
+    final_var_val_labels = {var: variables[var]['value_labels'] for var in final_col_labels_key if 'value_labels' in variables[var]}
+    final_var_widths = {var: variables[var]['display_width'] for var in final_col_labels_key if 'display_width' in variables[var]}
+    final_var_measures = {var: variables[var]['measure'] for var in final_col_labels_key if 'measure' in variables[var]}
+
+    # -- TEST FOR KEY/LABEL MATCHING -- #
+
+    #Both checks below run over the same key-label pairs, so they are kept as a list rather than a zip that the first loop would exhaust
+
+    zipped_labels = list(zip(final_col_labels_key, final_col_labels))
+
+    #Tests if proper label is associated with the proper variable
+
+    for (var, label) in zipped_labels:
+
+        if var not in column_names_to_labels_cleaned:
+
+            print(var + " was assigned '" + str(label) + "' as a column label manually.  Not present in original dataset.")
+
+        elif label != column_names_to_labels_cleaned[var][0] and var not in inconsistent_column_labels and 'label' not in config['metadata_overrides'].get(var, {}):
+
+            print("ADVISORY: There is a potential mismatch between the column label and associated key.  This can also be caused by including variables with inconsistent metadata.  Double check before using this dataset.  This advisory was flagged at the following variable: " + var)
+
+            print(column_names_to_labels_cleaned[var][0])
+
+    #Tests if labels are ordered properly (must be identical or order of the variables in the dataframe)
+
+    for (var, label), column in zip(zipped_labels, full_dataframe.columns):
+
+        if var != column:
+
+            print("WARNING: There is a mismatch between the dataframe's column order and the order of columns in the final zipped column key-label pairs.  Double check for extraneous or misplaced columns. This error was flagged at the following variable: " + var)
+
+    if len(zipped_labels) != len(full_dataframe.columns):
+
+        print("WARNING: The dataframe has " + str(len(full_dataframe.columns)) + " columns but the schema plan has " + str(len(zipped_labels)) + ".  Double check for extraneous or missing columns.")
+
+    #A no-op when the merge followed the plan; otherwise the frame is forced into the planned layout
+
+    if list(full_dataframe.columns) != final_col_labels_key:
+
+        full_dataframe = full_dataframe.reindex(columns=final_col_labels_key)
+
+    #The dataframe is written to SAV directly; the index and mixed-type columns that previously required a CSV round-trip are normalised first
+
+    sav_dataframe = prepare_dataframe_for_sav(full_dataframe)
+
+    print("Final dataframe shape: " + str(sav_dataframe.shape))
+    print("Number of column labels: " + str(len(final_col_labels)))
+
+    spss_metadata = validate_spss_metadata(sav_dataframe, {'column_labels': dict(zip(final_col_labels_key, final_col_labels)), 'variable_value_labels': final_var_val_labels, 'variable_measure': final_var_measures, 'variable_display_width': final_var_widths}, config)
+
+    return write_outputs(full_dataframe if merged_table is None else merged_table, sav_dataframe, spss_metadata, config, on_written)
+
+## -- POST MERGED SPSS FILE TO BOX -- ##
+
+def retry_box_call(config, description, function, *args, **kwargs):
+
+    #Box calls that time out or fail mid-transfer are retried with exponential backoff (1s, 2s, 4s, ...); the last failure is re-raised.  At least one attempt is always made, even if upload_retries was lowered after the config was built.
+
+    attempts = max(config['upload_retries'], 1)
+
+    for attempt in range(attempts):
+
+        try:
+
+            return function(*args, **kwargs)
+
+        except Exception as error:
+
+            if attempt == attempts - 1:
+
+                raise
+
+            print("Retrying " + description + " after error: " + str(error))
+
+            time.sleep(2 ** attempt)
+
+def upload_part(upload_session, path, offset, total_size, config):
+
+    #Each part is read from disk by its own worker, so only upload_workers parts are in memory at once
+
+    with open(path, 'rb') as open_file:
+
+        open_file.seek(offset)
+
+        part_bytes = open_file.read(upload_session.part_size)
+
+    return retry_box_call(config, 'part at byte ' + str(offset) + ' of ' + path, upload_session.upload_part_bytes, part_bytes, offset, total_size)
+
+def upload_output_file(box_client, file_id, path, config):
+
+    total_size = os.path.getsize(path)
+
+    start = time.perf_counter()
+
+    parts = 1
+
+    if total_size < config['chunked_upload_threshold']:
+
+        updated_file = retry_box_call(config, path, box_client.file(file_id).update_contents, path)
+
+    else:
+
+        upload_session = box_client.file(file_id).create_upload_session(total_size)
+
+        offsets = range(0, total_size, upload_session.part_size)
+
+        parts = len(offsets)
+
+        try:
+
+            with ThreadPoolExecutor(max_workers=config['upload_workers']) as executor:
+
+                uploaded_parts = list(executor.map(lambda offset: upload_part(upload_session, path, offset, total_size, config), offsets))
+
+            #Box checks the whole-file SHA1 on commit; commit returns None while Box is still processing the parts, so it is retried until the new version exists
+
+            content_sha1 = bytes.fromhex(hash_file(path))
+
+            updated_file = None
+
+            for attempt in range(config['upload_retries']):
+
+                updated_file = upload_session.commit(content_sha1, parts=uploaded_parts)
+
+                if updated_file is not None:
+
+                    break
+
+                time.sleep(2 ** attempt)
+
+            if updated_file is None:
+
+                raise IOError("Box did not finish processing the upload of " + path)
+
+        except Exception:
+
+            #An abandoned session would otherwise hold its uploaded parts on Box until it expires
+
+            upload_session.abort()
+
+            raise
+
+    seconds = time.perf_counter() - start
+
+    upload = {'path': path, 'bytes': total_size, 'parts': parts, 'seconds': round(seconds, 3), 'mb_per_second': round(total_size / 1e6 / max(seconds, 1e-3), 1)}
+
+    config['run_report']['uploads'].append(upload)
+
+    print(f'{updated_file.name} has been updated with a new version ({upload["mb_per_second"]} MB/s, {parts} part(s)).')
+
+    return upload
+
+def post_to_box(box_client, config):
+
+    folder_id = config['output_folder_id']
+
+    existing_files = box_client.folder(folder_id = folder_id).get_items()
+
+    file_names = []
+
+    #Only outputs written this run (recorded by write_output) are uploaded; a file left on disk by an earlier run in another merge mode or with other output_formats is never pushed to Box as a new version
+
+    targets = upload_targets(config)
+
+    uploads = []
+
+    for output in config['run_report']['outputs']:
+
+        file_id = targets[output['format']][0]
+
+        if file_id is not None:
+
+            uploads.append((file_id, output['path']))
+
+    for output_format, (file_id, path) in targets.items():
+
+        if file_id is not None and path not in [upload[1] for upload in uploads]:
+
+            print(f'{path} was not produced this run; skipping upload.')
+
+    #Outputs are uploaded side by side, each with its own pool of part uploads, so the CSV no longer waits for the SAV
+
+    with ThreadPoolExecutor(max_workers=max(len(uploads), 1)) as executor:
+
+        futures = [executor.submit(upload_output_file, box_client, file_id, path, config) for file_id, path in uploads]
+
+        results = [future.result() for future in futures]
+
+    remove_comment_workbooks()
+
+    return results
+
+def upload_targets(config):
+
+    return {'sav': (config['sav_file_id'], config['final_sav_path']), 'csv': (config['csv_file_id'], config['final_csv_path']), 'parquet': (config['parquet_file_id'], config['final_parquet_path'])}
+
+def remove_comment_workbooks():
+
+    for file in ['team_comments.xlsx', 'comments.xlsx']:
+
+        if os.path.exists(file):
+
+            os.remove(file)
+
+def start_uploads_as_written(box_client, config, executor):
+
+    #Returns a write_outputs callback that queues each output's upload the moment it is written, and the list its futures are collected in
+
+    futures = []
+
+    def on_written(output):
+
+        file_id = upload_targets(config)[output['format']][0]
+
+        if file_id is not None:
+
+            futures.append(executor.submit(upload_output_file, box_client, file_id, output['path'], config))
+
+    return on_written, futures
+
+def finish_uploads(futures, executor):
+
+    results = [future.result() for future in futures]
+
+    executor.shutdown()
+
+    remove_comment_workbooks()
+
+    return results
+
+## -- PIPELINED (ASYNCIO) DOWNLOAD, DECODE AND WRITE -- ##
+
+#Each pipeline is a chain of asyncio worker tasks joined by bounded queues: a stage blocks on put() when the next stage falls behind, so at most a queue's worth of work is ever waiting in memory.  The blocking work itself runs in thread or process pools.
+
+def run_pipeline(coroutine_function, *args):
+
+    return asyncio.run(coroutine_function(*args))
+
+async def run_pipeline_tasks(producers, consumers, queue):
+
+    #Producers and consumers run in one task group: when any of them fails the others are cancelled, so a dead consumer never leaves producers blocked on a full queue (or the reverse), and the first error reaches the caller as is.  Consumers stop at a None sentinel, one per consumer, queued once every producer is done.
+
+    try:
+
+        async with asyncio.TaskGroup() as group:
+
+            for consumer in consumers:
+
+                group.create_task(consumer)
+
+            await asyncio.gather(*[group.create_task(producer) for producer in producers])
+
+            for _ in consumers:
+
+                await queue.put(None)
+
+    except BaseExceptionGroup as errors:
+
+        raise errors.exceptions[0]
+
+async def download_and_read_metadata(box_client, config):
+
+    import pyreadstat
+
+    loop = asyncio.get_running_loop()
+
+    directory_items = await loop.run_in_executor(None, list_spss_items, box_client, config)
+
+    item_queue = asyncio.Queue()
+
+    for item in directory_items:
+
+        item_queue.put_nowait(item)
+
+    #Wave N's metadata is read while waves N+1... are still downloading; unchanged waves whose metadata is already cached are not read here at all
+
+    downloaded = asyncio.Queue(maxsize=max(config['read_workers'], 1) * 2)
+
+    cache_index = load_cache_index(config)
+
+    preloaded_metadata = {}
+
+    read_workers = max(config['read_workers'], 1)
+
+    read_pool = ProcessPoolExecutor(max_workers=read_workers) if read_workers > 1 else ThreadPoolExecutor(max_workers=1)
+
+    async def downloader(download_pool):
+
+        while not item_queue.empty():
+
+            item = item_queue.get_nowait()
+
+            await loop.run_in_executor(download_pool, download_spss_file, box_client, item, config)
+
+            await downloaded.put(item.name)
+
+    async def reader():
+
+        while True:
+
+            file = await downloaded.get()
+
+            if file is None:
+
+                return
+
+            path = os.path.join(config['temp_dir'], file)
+
+            if not file.endswith('.sav') or find_cache_entry(cache_index, file, await loop.run_in_executor(None, hash_wave, path, config), config) is not None:
+
+                continue
+
+            start = time.perf_counter()
+
+            df, meta = await loop.run_in_executor(read_pool, functools.partial(pyreadstat.read_sav, path, metadataonly=True))
+
+            record_wave(config, 'read_metadata', file, time.perf_counter() - start, bytes_read=os.path.getsize(path), rows=meta.number_rows, columns=len(meta.column_names))
+
+            preloaded_metadata[file] = meta
+
+    with read_pool, ThreadPoolExecutor(max_workers=config['download_workers']) as download_pool:
+
+        await run_pipeline_tasks([downloader(download_pool) for _ in range(config['download_workers'])], [reader() for _ in range(read_workers)], downloaded)
+
+    print("Downloaded " + str(len(directory_items)) + " files; read metadata for " + str(len(preloaded_metadata)) + " while downloading.")
+
+    return preloaded_metadata
+
+async def decode_and_store_waves(extracted_metadata, schema_plan, config):
+
+    loop = asyncio.get_running_loop()
+
+    active_files = extracted_metadata[1]
+
+    store_dir = prepare_columnar_store(config)
+
+    file_queue = asyncio.Queue()
+
+    for file in active_files:
+
+        file_queue.put_nowait(file)
+
+    #Decoded waves wait in a queue no longer than the number of decoders, so wave N is written to the store while wave N+1 is decoded, without decoded waves piling up in memory
+
+    decode_workers = max(config['read_workers'], 1)
+
+    decoded = asyncio.Queue(maxsize=decode_workers)
+
+    store_paths = {}
+
+    async def decoder(decode_pool):
+
+        while not file_queue.empty():
+
+            file = file_queue.get_nowait()
+
+            df = (await loop.run_in_executor(decode_pool, load_projected_waves, [file], schema_plan, extracted_metadata, config, read_pool))[0]
+
+            await decoded.put((file, df))
+
+    async def writer(write_pool):
+
+        while True:
+
+            wave = await decoded.get()
+
+            if wave is None:
+
+                return
+
+            file, df = wave
+
+            store_paths[file] = await loop.run_in_executor(write_pool, write_columnar_wave, df, os.path.join(store_dir, str(active_files.index(file)).zfill(4) + '.arrow'))
+
+    #pyreadstat holds the GIL while decoding, so the decodes themselves run in a process pool shared by all decoders; the decoder threads only wait on it and do the light recode and narrowing work, and the Arrow writes run on their own thread
+
+    read_pool = ProcessPoolExecutor(max_workers=decode_workers) if decode_workers > 1 else None
+
+    with read_pool or contextlib.nullcontext(), ThreadPoolExecutor(max_workers=decode_workers) as decode_pool, ThreadPoolExecutor(max_workers=1) as write_pool:
+
+        await run_pipeline_tasks([decoder(decode_pool) for _ in range(decode_workers)], [writer(write_pool)], decoded)
+
+    return [store_paths[file] for file in active_files], schema_plan['columns']
+
+## -- LIBRARY ENTRY POINT -- ##
+
+def merge_waves(config=None, box_client=None, mongo_db=None, explicit_overrides=None, offline=False, until='upload', memory_budget=None, run_report=None, **overrides):
+
+    #'until' stops the run after 'metadata' (inconsistency report and schema plan only), 'merge' (write outputs locally) or 'upload' (the full run).  Offline runs skip Box and Mongo and merge whatever is already in temp_dir.
+
+    config = build_config(config, **overrides)
+
+    #A caller-supplied (empty) run report is filled in place, so the stages that ran are still visible to the caller if the run fails part-way (see run_batch)
+
+    if run_report is not None:
+
+        config['run_report'] = run_report
+
+    results = {'config': config}
+
+    preloaded_metadata = None
+
+    #Print important information
+    print("Current working directory: " + str(os.getcwd()))
+
+    #Each stage is run through run_stage, which records its timing, memory and IO in the run report
+
+    if not offline:
+
+        if box_client is None:
+
+            box_client = run_stage(config, 'establish_box_connection', establish_box_connection, config)
+
+        if config['pipelined']:
+
+            preloaded_metadata = run_stage(config, 'download_and_read_metadata', run_pipeline, download_and_read_metadata, box_client, config)
+
+        else:
+
+            run_stage(config, 'download_spss_files', download_spss_files, box_client, config)
+
+    all_original_spss_files = run_stage(config, 'determine_import_list', determine_import_list, config)
+
+    if explicit_overrides is None:
+
+        explicit_overrides = load_local_explicit_overrides(config) if offline else run_stage(config, 'download_explicit_overrides', download_explicit_overrides, box_client, config)
+
+    if mongo_db is None and not offline and config['mongo_uri'] is not None:
+
+        mongo_db = run_stage(config, 'connect_to_mongo', connect_to_mongo, config)
+
+    if config['reclassify']:
+
+        run_stage(config, 'load_reclassifications', load_reclassifications, mongo_db, config)
+
+    extracted_metadata = run_stage(config, 'extract_metadata', extract_metadata, all_original_spss_files, config, preloaded_metadata)
+    variable_inclusion = run_stage(config, 'determine_variable_inclusion', determine_variable_inclusion, extracted_metadata, explicit_overrides, config)
+    key_metadata_types = run_stage(config, 'organize_metadata_by_var', organize_metadata_by_var, extracted_metadata, variable_inclusion)
+    inconsistencies = run_stage(config, 'find_inconsistent_variables', find_inconsistent_variables, key_metadata_types, variable_inclusion)
+    label_reconciliation = run_stage(config, 'reconcile_value_labels', reconcile_value_labels, key_metadata_types, inconsistencies, config)
+
+    #Reconciled variables are no longer inconsistent, so they are kept like any other variable
+
+    inconsistencies = (inconsistencies[0] - set(label_reconciliation), inconsistencies[1], inconsistencies[2])
+
+    schema_plan = run_stage(config, 'plan_merge_schema', plan_merge_schema, extracted_metadata, key_metadata_types, inconsistencies, variable_inclusion, config, label_reconciliation)
+
+    results.update({'extracted_metadata': extracted_metadata, 'variable_inclusion': variable_inclusion, 'key_metadata_types': key_metadata_types, 'inconsistencies': inconsistencies, 'label_reconciliation': label_reconciliation, 'schema_plan': schema_plan})
+
+    #In batch mode (see run_batch), concurrent projects share one memory budget; each reserves its planned merge size before reading any data
+
+    reserved_mb = 0 if until == 'metadata' or config['merge_mode'] == 'streaming' else schema_plan['estimate']['merged_mb']
+
+    with reserve_memory(memory_budget, reserved_mb):
+
+        if until != 'metadata':
+
+            #A pipelined run starts uploading each output as soon as it is written, rather than after the last one
+
+            overlap_uploads = config['pipelined'] and until == 'upload' and not offline and config['merge_mode'] != 'streaming'
+
+            upload_pool = ThreadPoolExecutor(max_workers=len(upload_targets(config))) if overlap_uploads else None
+
+            on_written, upload_futures = start_uploads_as_written(box_client, config, upload_pool) if overlap_uploads else (None, [])
+
+            if config['merge_mode'] == 'streaming':
+
+                #pyreadstat can only write a SAV file from a complete dataframe, so a streaming merge produces the CSV only
+
+                run_stage(config, 'stream_merged_csv', write_output, config, 'csv', config['final_csv_path'], stream_merged_csv, extracted_metadata, schema_plan, config)
+
+            else:
+
+                if config['merge_mode'] == 'columnar':
+
+                    if config['pipelined']:
+
+                        columnar_store = run_stage(config, 'decode_and_store_waves', run_pipeline, decode_and_store_waves, extracted_metadata, schema_plan, config)
+
+                    else:
+
+                        columnar_store = run_stage(config, 'build_columnar_store', build_columnar_store, extracted_metadata, schema_plan, config)
+
+                    merged_table = run_stage(config, 'open_columnar_store', open_columnar_store, columnar_store)
+
+                    #pyreadstat writes SAV files from pandas only, so the memory-mapped table is converted for that step
+
+                    full_dataframe = run_stage(config, 'columnar_store_to_dataframe', columnar_store_to_dataframe, merged_table)
+
+                    results['merged_table'] = merged_table
+
+                else:
+
+                    full_dataframe = run_stage(config, 'construct_csv', construct_csv, extracted_metadata, schema_plan, config)
+
+                run_stage(config, 'create_spss_file', create_spss_file, full_dataframe, schema_plan, key_metadata_types, inconsistencies, config, results.get('merged_table'), on_written)
+
+                results['full_dataframe'] = full_dataframe
+
+            if overlap_uploads:
+
+                run_stage(config, 'post_to_box', finish_uploads, upload_futures, upload_pool)
+
+            elif until == 'upload' and not offline:
+
+                run_stage(config, 'post_to_box', post_to_box, box_client, config)
+
+    write_run_report(config)
+
+    results['run_report'] = config['run_report']
+
+    return results
+
+## -- BATCH MODE: SEVERAL SURVEY PROGRAMS IN ONE WARM PROCESS -- ##
+
+#A manifest is a JSON file: {"defaults": {...settings shared by every project...}, "projects": [{"name": "program_a", "parent_file": ..., "spss_folder_id": ..., ...}, ...], "max_concurrent_projects": 2, "cpu_budget": 8, "memory_budget_mb": 16000}.  Each project's settings are layered over the defaults.
+
+#Local paths a project has not set explicitly are placed in a folder named after the project, so concurrent projects never share downloads, caches or outputs.  A relative default goes under the project folder in the working directory ('temp' -> 'program_a/temp'); an absolute default keeps its location with the project folder inserted before its last part ('/data/temp' -> '/data/program_a/temp').
+
+project_path_settings = ['temp_dir', 'cache_dir', 'overrides_path', 'final_sav_path', 'final_csv_path', 'final_parquet_path', 'run_report_path']
+
+def build_project_config(defaults, project, read_workers):
+
+    settings = {key: value for key, value in dict(defaults, **project).items() if key != 'name'}
+
+    for key in project_path_settings:
+
+        if key not in project:
+
+            path = os.path.normpath(settings.get(key, default_config[key]))
+
+            settings[key] = os.path.join(os.path.dirname(path), project['name'], os.path.basename(path)) if os.path.isabs(path) else os.path.join(project['name'], path)
+
+        if os.path.dirname(settings[key]):
+
+            os.makedirs(os.path.dirname(settings[key]), exist_ok=True)
+
+    #Each project gets an equal share of the CPU budget for its read pool unless it asks for something else
+
+    settings.setdefault('read_workers', read_workers)
+
+    return build_config(settings)
+
+def build_memory_budget(total_mb):
+
+    return None if total_mb is None else {'total_mb': total_mb, 'available_mb': total_mb, 'condition': threading.Condition()}
+
+@contextlib.contextmanager
+def reserve_memory(memory_budget, megabytes):
+
+    if memory_budget is None:
+
+        yield
+
+        return
+
+    #A project planned larger than the whole budget waits until it has the budget to itself
+
+    megabytes = min(megabytes, memory_budget['total_mb'])
+
+    condition = memory_budget['condition']
+
+    with condition:
+
+        condition.wait_for(lambda: memory_budget['available_mb'] >= megabytes)
+
+        memory_budget['available_mb'] -= megabytes
+
+    try:
+
+        yield
+
+    finally:
+
+        with condition:
+
+            memory_budget['available_mb'] += megabytes
+
+            condition.notify_all()
+
+def summarize_project(name, run_report, seconds, error=None):
+
+    #Peak RSS and IO counters are process-wide, so with concurrent projects they describe the whole batch up to the end of this project rather than this project alone
+
+    stages = run_report['stages']
+
+    return {'project': name,
+        'status': 'failed' if error else 'ok',
+        'error': error,
+        'seconds': round(seconds, 3),
+        'slowest_stage': max(stages, key=lambda stage: stage['wall_seconds'])['stage'] if stages else None,
+        'cpu_seconds': round(sum(stage['cpu_seconds'] for stage in stages), 3),
+        'peak_rss_mb': max([stage['peak_rss_mb'] or 0 for stage in stages] + [0]),
+        'rows': (run_report['plan'] or {}).get('rows'),
+        'columns': (run_report['plan'] or {}).get('columns'),
+        'planned_merged_mb': (run_report['plan'] or {}).get('merged_mb'),
+        'outputs': {output['format']: output['mb_per_second'] for output in run_report['outputs']},
+        'uploads': {output['path']: output['mb_per_second'] for output in run_report['uploads']}}
+
+def run_batch(manifest, offline=False, until='upload', box_client=None, mongo_db=None, report_path='batch_report.json'):
+
+    defaults = manifest.get('defaults', {})
+    projects = manifest['projects']
+
+    names = [project['name'] for project in projects]
+
+    if len(set(names)) != len(names):
+
+        raise ValueError("Project names in the batch manifest must be unique.")
+
+    max_concurrent_projects = max(1, min(manifest.get('max_concurrent_projects', 2), len(projects)))
+
+    cpu_budget = manifest.get('cpu_budget', os.cpu_count() or 1)
+
+    memory_budget = build_memory_budget(manifest.get('memory_budget_mb'))
+
+    #The Box JWT handshake and the Mongo TLS connection are paid once; boxsdk clients and pymongo's connection pool are safe to share between threads
+
+    shared_config = build_config(defaults)
+
+    if not offline:
+
+        if box_client is None:
+
+            box_client = run_stage(shared_config, 'establish_box_connection', establish_box_connection, shared_config)
+
+        if mongo_db is None and shared_config['mongo_uri'] is not None:
+
+            mongo_db = run_stage(shared_config, 'connect_to_mongo', connect_to_mongo, shared_config)
+
+    def run_project(project):
+
+        config = build_project_config(defaults, project, max(1, cpu_budget // max_concurrent_projects))
+
+        start = time.perf_counter()
+
+        run_report = config['run_report']
+
+        try:
+
+            merge_waves(config, box_client=box_client, mongo_db=mongo_db, offline=offline, until=until, memory_budget=memory_budget, run_report=run_report)
+
+            error = None
+
+        except Exception as exception:
+
+            #One failing program does not stop the rest of the nightly batch; its error is reported in the summary
+
+            error = type(exception).__name__ + ': ' + str(exception)
+
+            print("PROJECT " + project['name'] + " FAILED: " + error)
+
+        return summarize_project(project['name'], run_report, time.perf_counter() - start, error)
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_concurrent_projects) as executor:
+
+        summaries = list(executor.map(run_project, projects))
+
+    batch_report = {'seconds': round(time.perf_counter() - start, 3), 'max_concurrent_projects': max_concurrent_projects, 'cpu_budget': cpu_budget, 'memory_budget_mb': manifest.get('memory_budget_mb'), 'shared_stages': shared_config['run_report']['stages'], 'projects': summaries}
+
+    print("BATCH SUMMARY (" + str(batch_report['seconds']) + "s)")
+
+    for summary in summaries:
+
+        print(summary['project'].ljust(30) + summary['status'].ljust(8) + str(summary['seconds']).rjust(10) + 's' + str(summary['cpu_seconds']).rjust(10) + 's CPU' + str(summary['peak_rss_mb']).rjust(10) + ' MB peak  slowest: ' + str(summary['slowest_stage']))
+
+    with open(report_path, 'w') as open_file:
+
+        json.dump(batch_report, open_file, indent=2)
+
+    return batch_report
+
+## -- COMMAND LINE ENTRY POINT -- ##
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Merge multi-wave SPSS survey files from Box into a single SAV/CSV dataset.')
+    parser.add_argument('--config', help='JSON file of settings overriding default_config')
+    parser.add_argument('--parent-file', help='SAV file that serves as the metadata reference')
+    parser.add_argument('--read-workers', type=int)
+    parser.add_argument('--download-workers', type=int)
+    parser.add_argument('--merge-mode', choices=['memory', 'streaming', 'columnar'])
+    parser.add_argument('--pipelined', action='store_true', default=None, help='Overlap downloads, decoding, writing and uploads')
+    parser.add_argument('--offline', action='store_true', help='Skip Box and Mongo; merge the SAV files already in temp_dir')
+    parser.add_argument('--until', choices=['metadata', 'merge', 'upload'], default='upload', help='Last stage to run')
+    parser.add_argument('--batch', help='JSON manifest of projects to merge concurrently in one process (see run_batch)')
+    parser.add_argument('--dry-run', action='store_true', help='Print the resolved configuration and local waves, then exit without reading any data')
+    args = parser.parse_args(argv)
+
+    if args.batch:
+
+        with open(args.batch) as open_file:
+
+            return run_batch(json.load(open_file), offline=args.offline, until=args.until)
+
+    settings = {}
+
+    if args.config:
+
+        with open(args.config) as open_file:
+
+            settings = json.load(open_file)
+
+    for key in ['parent_file', 'read_workers', 'download_workers', 'merge_mode', 'pipelined']:
+
+        if getattr(args, key) is not None:
+
+            settings[key] = getattr(args, key)
+
+    config = build_config(settings)
+
+    if args.dry_run:
+
+        print(json.dumps({key: value for key, value in config.items() if key not in ['box_file_ids', 'reclassifications', 'file_hashes', 'run_report']}, indent=2))
+
+        if os.path.isdir(config['temp_dir']):
+
+            print("Waves in " + config['temp_dir'] + ": " + str(determine_import_list(config)))
+
+        return None
+
+    return merge_waves(config, offline=args.offline, until=args.until)
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,29 @@
+import os
+
+import pandas as pd
+import pyreadstat
+
+import spss_survey_merge as merge
+
+def test_text_categorical_in_one_wave_only(tmp_path, monkeypatch):
+
+    #Repeated answers make TXT categorical in w1 only (see narrow_wave_dtypes); the columnar merge must still match the in-memory one
+
+    os.makedirs(tmp_path / 'temp')
+
+    pyreadstat.write_sav(pd.DataFrame({'id': range(10), 'TXT': ['yes', 'no'] * 5}), str(tmp_path / 'temp' / 'w1.sav'))
+    pyreadstat.write_sav(pd.DataFrame({'id': range(10), 'TXT': ['a' + str(i) for i in range(10)]}), str(tmp_path / 'temp' / 'w2.sav'))
+
+    monkeypatch.chdir(tmp_path)
+
+    overrides = pd.DataFrame({'Force-Include / Force-Exclude': [], 'Variable': []})
+
+    outputs = {}
+
+    for merge_mode in ['memory', 'columnar']:
+
+        merge.merge_waves({'parent_file': 'w1.sav', 'mongo_uri': None, 'merge_mode': merge_mode, 'output_formats': ['csv']}, explicit_overrides=overrides, offline=True, until='merge')
+
+        outputs[merge_mode] = (tmp_path / 'FinalCSVDataFrameCopy.csv').read_text()
+
+    assert outputs['memory'] == outputs['columnar']
@@ -0,0 +1,92 @@
+import asyncio
+import importlib.util
+import os
+import threading
+
+import pandas as pd
+import pyreadstat
+import pytest
+
+import spss_survey_merge as merge
+
+#The simulated Box client lives in the benchmark script, whose file name is not importable as a module
+
+spec = importlib.util.spec_from_file_location('benchmark', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark-spss-survey-merge.py'))
+benchmark = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(benchmark)
+
+def write_waves(directory, corrupt=None):
+
+    os.makedirs(directory, exist_ok=True)
+
+    for i in range(4):
+
+        path = os.path.join(directory, 'w' + str(i) + '.sav')
+
+        if i == corrupt:
+
+            with open(path, 'wb') as open_file:
+
+                open_file.write(b'not a sav file' * 100)
+
+        else:
+
+            pyreadstat.write_sav(pd.DataFrame({'id': range(i * 10, i * 10 + 10), 'q': [1.0, 2.0] * 5}), path)
+
+def run_with_timeout(function, seconds=60):
+
+    #A hang fails the test instead of blocking the whole suite
+
+    outcome = {}
+
+    def target():
+
+        try:
+
+            outcome['result'] = function()
+
+        except BaseException as error:
+
+            outcome['error'] = error
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(seconds)
+
+    assert not thread.is_alive(), "pipeline hung"
+
+    if 'error' in outcome:
+
+        raise outcome['error']
+
+    return outcome['result']
+
+def test_corrupt_wave_fails_download_pipeline(tmp_path):
+
+    write_waves(str(tmp_path / 'box'), corrupt=1)
+
+    config = merge.build_config(temp_dir=str(tmp_path / 'temp'), cache_dir=str(tmp_path / 'cache'), read_workers=1, download_workers=1, pipelined=True)
+
+    client = benchmark.FakeBoxClient(str(tmp_path / 'box'))
+
+    with pytest.raises(pyreadstat.ReadstatError):
+
+        run_with_timeout(lambda: asyncio.run(merge.download_and_read_metadata(client, config)))
+
+def test_failing_writer_fails_decode_pipeline(tmp_path, monkeypatch):
+
+    write_waves(str(tmp_path / 'temp'))
+
+    monkeypatch.chdir(tmp_path)
+
+    def fail(df, path):
+
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(merge, 'write_columnar_wave', fail)
+
+    overrides = pd.DataFrame({'Force-Include / Force-Exclude': [], 'Variable': []})
+
+    with pytest.raises(OSError, match='No space left'):
+
+        run_with_timeout(lambda: merge.merge_waves({'parent_file': 'w0.sav', 'mongo_uri': None, 'merge_mode': 'columnar', 'pipelined': True, 'read_workers': 1}, explicit_overrides=overrides, offline=True, until='merge'))
@@ -0,0 +1,73 @@
+import mongomock
+import numpy as np
+import pandas as pd
+
+import spss_survey_merge as merge
+
+#Mongo mappings and corrections are checked against mongomock, so no server is needed
+
+def make_database():
+
+    mongo_db = mongomock.MongoClient()['survey']
+
+    mongo_db['mappings'].insert_many([
+        {'variable': 'Q1', 'mapping': {'1': 10, '2': 20}, 'updated_at': 1},
+        {'variable': 'Q2', 'mapping': {'a': 'b'}, 'files': ['w1.sav'], 'updated_at': 2}])
+
+    mongo_db['corrections'].insert_one({'variable': 'Q3', 'mapping': {'1': 2, '999999999': None}, 'updated_at': 3})
+
+    return mongo_db
+
+def test_load_and_apply_reclassifications(tmp_path):
+
+    config = merge.build_config(cache_dir=str(tmp_path))
+
+    rules = merge.load_reclassifications(make_database(), config)
+
+    assert [rule['variable'] for rule in rules] == ['Q1', 'Q2', 'Q3']
+
+    df = pd.DataFrame({'Q1': [1.0, 2.0, 3.0, np.nan], 'Q2': ['a', 'a', 'c', 'a'], 'Q3': [1.0, 999999999.0, 5.0, 1.0]})
+
+    merge.apply_reclassifications(df, 'w1.sav', rules)
+
+    assert df['Q1'].tolist()[:3] == [10.0, 20.0, 3.0] and np.isnan(df['Q1'].iloc[3])
+    assert df['Q2'].tolist() == ['b', 'b', 'c', 'b']
+    assert df['Q3'].iloc[0] == 2.0 and np.isnan(df['Q3'].iloc[1]) and df['Q3'].iloc[2] == 5.0
+
+def test_rules_limited_to_files(tmp_path):
+
+    rules = merge.load_reclassifications(make_database(), merge.build_config(cache_dir=str(tmp_path)))
+
+    df = pd.DataFrame({'Q2': ['a']})
+
+    merge.apply_reclassifications(df, 'w2.sav', rules)
+
+    assert df['Q2'].tolist() == ['a']
+
+def test_cached_documents_reused_until_collection_changes(tmp_path):
+
+    mongo_db = make_database()
+
+    merge.load_reclassifications(mongo_db, merge.build_config(cache_dir=str(tmp_path)))
+
+    mongo_db['mappings'].insert_one({'variable': 'Q4', 'mapping': {'1': 0}, 'updated_at': 4})
+
+    rules = merge.load_reclassifications(mongo_db, merge.build_config(cache_dir=str(tmp_path)))
+
+    assert 'Q4' in [rule['variable'] for rule in rules]
+
+    #Offline runs fall back to the documents cached by the last online run
+
+    rules = merge.load_reclassifications(None, merge.build_config(cache_dir=str(tmp_path)))
+
+    assert 'Q4' in [rule['variable'] for rule in rules]
+
+def test_sparse_and_non_finite_codes_skip_dense_lookup():
+
+    rules = merge.compile_reclassifications([
+        {'variable': 'Q', 'mapping': {'1': 2, '999999999': None}},
+        {'variable': 'R', 'mapping': {'inf': 1, 'nan': 2, '3': 4}},
+        {'variable': 'S', 'mapping': {'1': 2, '3': 4}}])
+
+    assert rules[0]['lookup'] is None and rules[1]['lookup'] is None
+    assert rules[2]['lookup'].tolist() == [2.0, 2.0, 4.0]